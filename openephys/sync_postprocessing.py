@@ -24,6 +24,11 @@ from os import path
 import os
 import sys
 import platform
+from bisect import bisect_left
+
+# add scripts path to sys path for the session csv loader
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), "scripts"))
+from session_csv import load_session_csv, COLUMNS
 
 default = (6,4)
 
@@ -58,46 +63,54 @@ def load_oo_events(rec_folder):
     return oe_events_df
 
 def extract_events_oo(oe_events_df):
+    """decode bnc1 / bnc2 ttl edges into trial start, event, reward and end events
+
+    bnc1 and bnc2 rising at the same time mark a trial start, the next such pair the last
+    event and end of the trial. within a trial, bnc1 edges (not paired with bnc2) are
+    reward events and unpaired bnc2 edges are normal events.
+    """
     oe_sync_df = (oe_events_df.loc[np.logical_or(oe_events_df['channel']==1, oe_events_df['channel']==2)]).copy()
     oe_sync_df.reset_index(inplace=True,drop=True)
-    oe_trials = []
-
-    trial=False
-    bnc1=-1
-    bnc2=-1
-    for row in  oe_sync_df.index.values[1:]:
-        # check bnc state
-        if oe_sync_df.loc[row,"channel"]==1:
-            bnc1=oe_sync_df.loc[row,"event"]
-        if oe_sync_df.loc[row,"channel"]==2:
-            bnc2=oe_sync_df.loc[row,"event"]
-        # 1 2 = start
-        if oe_sync_df.loc[row,"event"]==2 and oe_sync_df.loc[row-1,"event"]==1:
-            if oe_sync_df.loc[row,"ms_relativ"]==oe_sync_df.loc[row-1,"ms_relativ"]:
-                if trial == False:
-                    oe_trials.append([oe_sync_df.loc[row,"ms_relativ"],"start"])
-                    #oe_trials.append([oe_sync_df.loc[row+1,"ms_relativ"],"event"])
-                    trial=True
-                elif trial == True:
-                    oe_trials.append([oe_sync_df.loc[row,"ms_relativ"],"event"])
-                    oe_trials.append([oe_sync_df.loc[row+1,"ms_relativ"],"event"])
-                    oe_trials.append([oe_sync_df.loc[row+1,"ms_relativ"],"end"])
-                    trial=False
-
-        # 1 0 = reward event
-        if oe_sync_df.loc[row,"channel"]==1 and trial:
-            if not(oe_sync_df.loc[row+1,"channel"]==2 and oe_sync_df.loc[row,"ms_relativ"]==oe_sync_df.loc[row+1,"ms_relativ"]):
-                oe_trials.append([oe_sync_df.loc[row,"ms_relativ"],"reward_event"])
-                #oe_events.append([oe_sync_df.loc[row+1,"s_relativ"],"reward_end"])
-
-        # 0 1 = normal event
-        if oe_sync_df.loc[row,"channel"]==2:
-            if not(oe_sync_df.loc[row-1,"event"]==1 and oe_sync_df.loc[row,"ms_relativ"]==oe_sync_df.loc[row-1,"ms_relativ"]) and trial:
-                oe_trials.append([oe_sync_df.loc[row,"ms_relativ"],"event"])
-                #oe_events.append([oe_sync_df.loc[row+1,"s_relativ"],"reward_end"])
-
-
-    oe_trials_df = pd.DataFrame(oe_trials,columns=["ms_relativ","event_type"]) 
+
+    channel = oe_sync_df["channel"].to_numpy()
+    event = oe_sync_df["event"].to_numpy()
+    ms = oe_sync_df["ms_relativ"].to_numpy()
+    rows = np.arange(len(ms))
+
+    # values of the previous / next edge, nan where there is none
+    prev_event = np.r_[np.nan, event[:-1]]
+    prev_ms = np.r_[np.nan, ms[:-1]]
+    next_channel = np.r_[channel[1:], np.nan]
+    next_ms = np.r_[ms[1:], np.nan]
+    not_first = rows > 0
+
+    # 1 2 = start / end, every pair toggles the trial flag
+    pair = not_first & (event==2) & (prev_event==1) & (ms==prev_ms)
+    trial = np.cumsum(pair) % 2 == 1
+    start = pair & trial
+    end = pair & ~trial
+
+    # 1 0 = reward event
+    reward = not_first & (channel==1) & trial & ~((next_channel==2) & (ms==next_ms))
+
+    # 0 1 = normal event
+    normal = not_first & (channel==2) & ~((prev_event==1) & (ms==prev_ms)) & trial
+
+    # collect all events, ordered by edge and by the order they were found for each edge
+    end_rows = rows[end]
+    found = [(rows[start], ms[start], "start"),
+             (end_rows, ms[end], "event"),
+             (end_rows, next_ms[end], "event"),
+             (end_rows, next_ms[end], "end"),
+             (rows[reward], ms[reward], "reward_event"),
+             (rows[normal], ms[normal], "event")]
+    order_rows = np.concatenate([f[0] for f in found])
+    order_sub = np.concatenate([np.full(len(f[0]), i) for i, f in enumerate(found)])
+    times = np.concatenate([f[1] for f in found])
+    types = np.concatenate([np.full(len(f[0]), f[2], dtype=object) for f in found])
+    order = np.lexsort((order_sub, order_rows))
+
+    oe_trials_df = pd.DataFrame({"ms_relativ": times[order], "event_type": types[order]})
     return oe_trials_df
 
 def convert_to_seconds(csv_string):
@@ -109,24 +122,29 @@ def convert_to_seconds(csv_string):
 def load_bp_events(root_dir,session):
     #specify path
     if platform.system() == 'Linux':
-        event_folder = (root_dir + "/experiments/gamble_task/setups/gamble_task_recording/sessions")
+        folder = (root_dir + "/experiments/gamble_task/setups/gamble_task_recording/sessions")
     elif platform.system() == 'Windows':
         folder = (root_dir + r"\experiments\gamble_task\setups\gamble_task_recording\sessions")
     elif platform.system() == 'Darwin': #macos
         folder= (root_dir + "/experiments/gamble_task/setups/gamble_task_recording/sessions")
     
     ext = ".csv"
-    # read csv
-    session_df = pd.read_csv(path.join(folder,session,session)+ext,sep=';',header=6)
-    #convert string to datetime
-    session_df["datetime"]=(pd.to_datetime(session_df["PC-TIME"].values,format="%Y-%m-%d %H:%M:%S.%f")).values
+    # read csv, typed columns from the cached sidecar if the csv did not change
+    session_df = load_session_csv(path.join(folder,session,session)+ext,columns=COLUMNS)
+    session_df["datetime"]=session_df["PC-TIME"]
     # get milliseconds
-    session_df["ms_absolut"]=session_df["datetime"].apply(lambda x: x.timestamp()*1000)
+    session_df["ms_absolut"]=session_df["PC-TIME"].to_numpy().astype('datetime64[us]').astype(np.int64)/1000
     session_df["ms_relativ"]=session_df["ms_absolut"]-session_df.loc[14,"ms_absolut"]
 
     return session_df
 
-def get_sync(openephys_dir,pybpod_root,pybpod_session):
+def load_sync_events(openephys_dir,pybpod_root,pybpod_session):
+    """load the bpod csv and open ephys ttl events of a recording
+
+    returns the csv dataframe, its states with ms_relativ relative to the session, the trial
+    start times of the csv, the raw ttl events and the decoded ttl events without the
+    duplicate event in front of every trial end.
+    """
     pb_events_df = load_bp_events(pybpod_root,pybpod_session)
     # extract states
     states_df = pb_events_df.loc[pb_events_df.TYPE=='STATE']
@@ -135,15 +153,11 @@ def get_sync(openephys_dir,pybpod_root,pybpod_session):
     starts = pb_events_df.loc[pb_events_df.loc[(pb_events_df.TYPE=='TRIAL')].index,'ms_relativ'].copy()
     starts.reset_index(inplace=True,drop=True)
 
-    start_idx = -1
-    trial=False
-    for idx in states_df.index:
-        if states_df.loc[idx,'BPOD-INITIAL-TIME']==0:
-            start_idx+=1
-        states_df.loc[idx,'ms_relativ']=states_df.loc[idx,'BPOD-INITIAL-TIME']*1000+starts.loc[start_idx]
-
-    pb_sync_df = states_df#states_df.loc[:,["MSG","ms_relativ","BPOD-INITIAL-TIME"]]
-
+    # a state with BPOD-INITIAL-TIME 0 starts a new trial, states are relative to the trial start
+    initial_time = states_df['BPOD-INITIAL-TIME'].to_numpy(dtype=float)
+    trial_id = np.cumsum(initial_time==0) - 1
+    trial_start = np.where(trial_id >= 0, starts.to_numpy(dtype=float)[trial_id.clip(0)], np.nan)
+    states_df['ms_relativ'] = initial_time*1000 + trial_start
 
     # load openephys ttl
     oe_events_df = load_oo_events(openephys_dir)
@@ -154,6 +168,12 @@ def get_sync(openephys_dir,pybpod_root,pybpod_session):
     not_select = oe_trials_df.index.isin(oe_end_idx.values-1)
     oe_trials_df = oe_trials_df.loc[~not_select]
 
+    return pb_events_df, states_df, starts, oe_events_df, oe_trials_df
+
+def get_sync(openephys_dir,pybpod_root,pybpod_session):
+    _, states_df, _, _, oe_trials_df = load_sync_events(openephys_dir,pybpod_root,pybpod_session)
+    pb_sync_df = states_df#states_df.loc[:,["MSG","ms_relativ","BPOD-INITIAL-TIME"]]
+
     #oe_trials_df=oe_trials_df.loc[np.invert(oe_trials_df.event_type=='end')]
 
 
@@ -171,12 +191,20 @@ def get_sync(openephys_dir,pybpod_root,pybpod_session):
     """
 
 
-    # create combined
-    combined_ar = np.zeros([pb_sync_df.shape[0],11],dtype=object)
-    combined_ar[:oe_trials_df.shape[0],0:2]=oe_trials_df.values
-    combined_ar[:pb_sync_df.shape[0],2:11]=pb_sync_df.values
-    combined_df=pd.DataFrame(combined_ar,columns=["TTL Start norm","TTL Event","CSV Type","CSV Pctime","CSV in trial start","CSV in trial end",
-                                                "CSV Event","CSV info","CSV Datetime","CSV Start","CSV Start norm"])
+    # create combined, ttl events are paired with csv states by position, missing ttl events are 0
+    n_rows = pb_sync_df.shape[0]
+    n_ttl = min(oe_trials_df.shape[0], n_rows)
+    ttl_start = np.zeros(n_rows)
+    ttl_start[:n_ttl] = oe_trials_df["ms_relativ"].to_numpy()[:n_ttl]
+    ttl_event = np.zeros(n_rows, dtype=object)
+    ttl_event[:n_ttl] = oe_trials_df["event_type"].to_numpy()[:n_ttl]
+
+    combined_df = pd.DataFrame({"TTL Start norm": ttl_start, "TTL Event": ttl_event})
+    csv_columns = {"TYPE": "CSV Type", "PC-TIME": "CSV Pctime", "BPOD-INITIAL-TIME": "CSV in trial start",
+                   "BPOD-FINAL-TIME": "CSV in trial end", "MSG": "CSV Event", "+INFO": "CSV info",
+                   "datetime": "CSV Datetime", "ms_absolut": "CSV Start", "ms_relativ": "CSV Start norm"}
+    for column, csv_column in csv_columns.items():
+        combined_df[csv_column] = pb_sync_df[column].to_numpy()
     combined_df["Delta (TTL-CSV)"]=combined_df["TTL Start norm"]-combined_df["CSV Start norm"]
 
     # model like phenosys sync df for futher analysis
@@ -186,6 +214,327 @@ def get_sync(openephys_dir,pybpod_root,pybpod_session):
 
 
 
+# Clock alignment =======================================================================================
+
+class ClockModel:
+    """piecewise linear map from bpod time to open ephys time, fitted by align_clocks
+
+    every segment [breaks[k], breaks[k+1]) has its own offset (open ephys ms at breaks[k])
+    and slope, so clock drift and jumps of the bpod time base between segments are modeled.
+
+    usage:
+        model(bp_ms)         # open ephys sample numbers
+        model.to_ms(bp_ms)   # open ephys ms, same time base as the ttl ms_relativ
+        model.matches        # matched event pairs with their residuals
+        model.summary()      # residual and drift diagnostics
+    """
+
+    def __init__(self, breaks, offset, slope, sample_rate, first_sample, matches, n_bp, n_oe):
+        self.breaks = breaks
+        self.offset = offset
+        self.slope = slope
+        self.sample_rate = sample_rate
+        self.first_sample = first_sample
+        self.matches = matches
+        self.n_bp = n_bp
+        self.n_oe = n_oe
+
+    def _segment(self, bp_ms):
+        return np.clip(np.searchsorted(self.breaks, bp_ms, 'right') - 1, 0, len(self.breaks) - 1)
+
+    def to_ms(self, bp_ms):
+        bp_ms = np.asarray(bp_ms, dtype=float)
+        seg = self._segment(bp_ms)
+        return self.offset[seg] + self.slope[seg]*(bp_ms - self.breaks[seg])
+
+    def __call__(self, bp_ms):
+        return self.first_sample + self.to_ms(bp_ms)*self.sample_rate/1000
+
+    @property
+    def residuals(self):
+        """open ephys minus predicted time of every matched pair in ms"""
+        return self.matches["residual_ms"].to_numpy()
+
+    def summary(self):
+        residuals = self.residuals
+        used = self.matches["used"].to_numpy()
+        return {"matched": len(residuals),
+                "used_in_fit": int(used.sum()),
+                "unmatched_bp": self.n_bp - len(residuals),
+                "unmatched_oe": self.n_oe - len(residuals),
+                "residual_median_abs_ms": float(np.median(np.abs(residuals[used]))),
+                "residual_std_ms": float(np.std(residuals[used])),
+                "residual_max_abs_ms": float(np.max(np.abs(residuals))),
+                "drift_ppm": float(np.median(self.slope - 1)*1e6)}
+
+def _initial_offset(oe_ms, bp_ms, tolerance, n=500):
+    """most common open ephys - bpod time difference among the first n events of both streams"""
+    diffs = (oe_ms[:n,None] - bp_ms[None,:n]).ravel()
+    bins = np.round(diffs/tolerance)
+    values, counts = np.unique(bins, return_counts=True)
+    best = values[np.argmax(counts)]
+    return np.median(diffs[bins==best])
+
+def _increasing_subsequence(values):
+    """indices of a longest strictly increasing subsequence, O(n log n)"""
+    tails = []
+    tail_idx = []
+    previous = np.full(len(values), -1)
+    for i, value in enumerate(values):
+        k = bisect_left(tails, value)
+        if k == len(tails):
+            tails.append(value)
+            tail_idx.append(i)
+        else:
+            tails[k] = value
+            tail_idx[k] = i
+        previous[i] = tail_idx[k-1] if k > 0 else -1
+    selected = []
+    i = tail_idx[-1] if tail_idx else -1
+    while i >= 0:
+        selected.append(i)
+        i = previous[i]
+    return np.array(selected[::-1], dtype=int)
+
+def _monotonic(values):
+    """indices of a longest strictly increasing subsequence of values
+
+    a value above everything before it and below everything after it is in order with all
+    others, so the subsequence is only searched within the runs between such values.
+    """
+    below = np.r_[-np.inf, np.maximum.accumulate(values)[:-1]] < values
+    above = values < np.r_[np.minimum.accumulate(values[::-1])[::-1][1:], np.inf]
+    safe = below & above
+    keep = [np.flatnonzero(safe)]
+    edges = np.diff(np.r_[0, (~safe).astype(int), 0])
+    for start, stop in zip(np.flatnonzero(edges==1), np.flatnonzero(edges==-1)):
+        keep.append(start + _increasing_subsequence(values[start:stop]))
+    return np.sort(np.concatenate(keep))
+
+def _group_events(times, types, selected):
+    """positions and times of the events of every selected type"""
+    groups = {}
+    for event_type in selected:
+        idx = np.flatnonzero(types==event_type)
+        groups[event_type] = (idx, times[idx])
+    return groups
+
+def _match_events(oe_groups, predicted, bp_types, tolerance, first=0):
+    """pair every bpod event with the nearest open ephys event of the same type
+
+    predicted are the open ephys times of the bpod events first, first+1, ... under the
+    current model. pairs further apart than tolerance are dropped, every open ephys event
+    keeps only its closest bpod event and pairs that break the order of both streams are
+    removed.
+    """
+    bp_idx, oe_idx, dist = [], [], []
+    for event_type, (oe_sel, ref) in oe_groups.items():
+        bp_sel = np.flatnonzero(bp_types==event_type)
+        if len(ref)==0 or len(bp_sel)==0:
+            continue
+        pred = predicted[bp_sel]
+        pos = np.searchsorted(ref, pred)
+        left = np.clip(pos - 1, 0, len(ref) - 1)
+        right = np.clip(pos, 0, len(ref) - 1)
+        d_left = np.abs(pred - ref[left])
+        d_right = np.abs(ref[right] - pred)
+        nearest = np.where(d_right < d_left, right, left)
+        d = np.minimum(d_left, d_right)
+        ok = d <= tolerance
+        bp_idx.append(bp_sel[ok] + first)
+        oe_idx.append(oe_sel[nearest[ok]])
+        dist.append(d[ok])
+    if not bp_idx:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    bp_idx = np.concatenate(bp_idx)
+    oe_idx = np.concatenate(oe_idx)
+    dist = np.concatenate(dist)
+
+    # one to one, keep the closest bpod event of every open ephys event
+    order = np.lexsort((dist, oe_idx))
+    unique = np.r_[True, oe_idx[order][1:] != oe_idx[order][:-1]]
+    keep = order[unique]
+    keep = keep[np.argsort(bp_idx[keep])]
+    bp_idx, oe_idx = bp_idx[keep], oe_idx[keep]
+
+    # monotonic, both streams have to stay in order
+    if np.any(np.diff(oe_idx) <= 0):
+        keep = _monotonic(oe_idx)
+        bp_idx, oe_idx = bp_idx[keep], oe_idx[keep]
+    return bp_idx, oe_idx
+
+def _propagate_segments(oe_t, oe_groups, bp_t, bp_ty, seg, breaks, offset0, tolerance, max_drift):
+    """first pass, segment by segment in time. every segment starts from the line of the last
+    segment with matches and is matched in windows that double in length, refitting the
+    line in between, so drift over a long recording stays within the tolerance."""
+    n_seg = len(breaks)
+    bounds = np.searchsorted(seg, np.arange(n_seg + 1))
+    offset = np.empty(n_seg)
+    slope = np.ones(n_seg)
+    last_break, last_offset, last_slope = breaks[0], breaks[0] + offset0, 1.
+    bp_idx, oe_idx = [], []
+    for k in range(n_seg):
+        lo, hi = bounds[k], bounds[k+1]
+        offset[k] = last_offset + last_slope*(breaks[k] - last_break)
+        slope[k] = last_slope
+        if hi==lo:
+            continue
+
+        # the drift over the first window is at most max_drift*window <= tolerance
+        window = tolerance/max_drift
+        while True:
+            stop = lo + np.searchsorted(bp_t[lo:hi], breaks[k] + window, 'right')
+            predicted = offset[k] + slope[k]*(bp_t[lo:stop] - breaks[k])
+            b, o = _match_events(oe_groups, predicted, bp_ty[lo:stop], tolerance, lo)
+            if len(b) > 0:
+                x = bp_t[b] - breaks[k]
+                y = oe_t[o]
+                fit_slope = np.polyfit(x, y, 1)[0] if len(b) >= 2 and np.ptp(x) > 0 else slope[k]
+                if abs(fit_slope - 1) < max_drift:
+                    slope[k] = fit_slope
+                offset[k] = np.median(y - slope[k]*x)
+            if stop==hi:
+                break
+            window *= 2
+
+        if len(b) > 0:
+            last_break, last_offset, last_slope = breaks[k], offset[k], slope[k]
+            bp_idx.append(b)
+            oe_idx.append(o)
+    if not bp_idx:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    return np.concatenate(bp_idx), np.concatenate(oe_idx)
+
+def _fit_segments(x, y, seg, breaks, min_step):
+    """robust least squares line for every segment, segments without data are extrapolated
+    from their closest neighbour"""
+    n_seg = len(breaks)
+    used = np.ones(len(x), dtype=bool)
+    for _ in range(4):
+        xs = x[used] - breaks[seg[used]]
+        ys = y[used]
+        s = seg[used]
+        n = np.bincount(s, minlength=n_seg).astype(float)
+        sx = np.bincount(s, xs, n_seg)
+        sy = np.bincount(s, ys, n_seg)
+        sxx = np.bincount(s, xs*xs, n_seg)
+        sxy = np.bincount(s, xs*ys, n_seg)
+
+        # global slope for segments with a single event or no spread in time
+        xg = x[used] - x[used].mean()
+        global_slope = np.sum(xg*(ys - ys.mean()))/np.sum(xg*xg) if np.sum(xg*xg) > 0 else 1.
+        den = n*sxx - sx*sx
+        fitted = (n >= 2) & (den > 1e-9*np.maximum(n*sxx, 1))
+        slope = np.where(fitted, (n*sxy - sx*sy)/np.where(fitted, den, 1), global_slope)
+        offset = (sy - slope*sx)/np.maximum(n, 1)
+
+        # segments without data take the line of the previous (or next) segment
+        has = n > 0
+        idx = np.arange(n_seg)
+        prev = np.maximum.accumulate(np.where(has, idx, -1))
+        nxt = np.minimum.accumulate(np.where(has, idx, n_seg)[::-1])[::-1]
+        src = np.where(prev >= 0, prev, nxt)
+        offset = offset[src] + slope[src]*(breaks - breaks[src])
+        slope = slope[src]
+
+        residuals = y - (offset[seg] + slope[seg]*(x - breaks[seg]))
+        mad = np.median(np.abs(residuals[used] - np.median(residuals[used])))
+        new_used = np.abs(residuals) <= max(4*1.4826*mad, min_step)
+        if np.array_equal(new_used, used) or new_used.sum() < 2:
+            break
+        used = new_used
+    return offset, slope, residuals, used
+
+def align_clocks(oe_ms, bp_ms, oe_types=None, bp_types=None, anchor_types=None, breaks=None,
+                 segment=60000., tolerance=5., max_drift=1e-3, sample_rate=30000., first_sample=0, n_iter=3):
+    """match open ephys ttl events and bpod events and fit a drift corrected clock model
+
+    oe_ms, bp_ms:     event times of both streams in ms
+    oe_types, bp_types: optional event labels, only events with the same label are matched
+    anchor_types:     labels used for the first pass, e.g. ('start', 'end'). rare events
+                      give an unambiguous first model, which then matches the dense events
+    breaks:           bpod times where a new linear segment starts, e.g. the trial starts.
+                      by default a segment every segment ms
+    tolerance:        maximal distance in ms of a matched pair
+    max_drift:        largest relative rate difference of the clocks within a segment
+    n_iter:           matching passes, the first uses the anchors only
+
+    matching is nearest neighbour with searchsorted under the current model, restricted
+    to one to one and monotonic pairs, so alignment is O(n log n). the first pass walks
+    through the segments in time and extrapolates each from the last one with matches,
+    later passes rematch all events under the robust fit. returns a ClockModel.
+    """
+    oe_ms = np.asarray(oe_ms, dtype=float)
+    bp_ms = np.asarray(bp_ms, dtype=float)
+    oe_types = np.zeros(len(oe_ms), dtype=int) if oe_types is None else np.asarray(oe_types)
+    bp_types = np.zeros(len(bp_ms), dtype=int) if bp_types is None else np.asarray(bp_types)
+
+    # sort both streams, keep the original positions for the diagnostics
+    bp_pos = np.flatnonzero(~np.isnan(bp_ms))
+    bp_pos = bp_pos[np.argsort(bp_ms[bp_pos], kind='stable')]
+    oe_pos = np.argsort(oe_ms, kind='stable')
+    # integer codes for the labels, comparisons of codes are much faster than of strings
+    labels, codes = np.unique(np.r_[oe_types, bp_types], return_inverse=True)
+    oe_codes, bp_codes = codes[:len(oe_types)], codes[len(oe_types):]
+    bp_t, bp_ty = bp_ms[bp_pos], bp_codes[bp_pos]
+    oe_t, oe_ty = oe_ms[oe_pos], oe_codes[oe_pos]
+    if len(bp_t) < 2 or len(oe_t) < 2:
+        raise Exception('at least two events per stream are needed to align clocks')
+
+    if breaks is None:
+        breaks = np.arange(bp_t[0], bp_t[-1] + segment, segment)
+    breaks = np.unique(np.asarray(breaks, dtype=float))
+    seg = np.clip(np.searchsorted(breaks, bp_t, 'right') - 1, 0, len(breaks) - 1)
+
+    types = np.intersect1d(np.unique(oe_ty), np.unique(bp_ty))
+    anchors = types if anchor_types is None else np.intersect1d(types, np.flatnonzero(np.isin(labels, anchor_types)))
+    oe_anchor = oe_t[np.isin(oe_ty, anchors)]
+    bp_anchor = bp_t[np.isin(bp_ty, anchors)]
+    if len(oe_anchor)==0 or len(bp_anchor)==0:
+        raise Exception('no events of a common type to align clocks')
+
+    anchor_groups = _group_events(oe_t, oe_ty, anchors)
+    all_groups = _group_events(oe_t, oe_ty, types)
+    offset0 = _initial_offset(oe_anchor, bp_anchor, tolerance)
+    min_step = 1000/sample_rate
+    for i in range(n_iter):
+        if i==0:
+            bp_idx, oe_idx = _propagate_segments(oe_t, anchor_groups, bp_t, bp_ty, seg, breaks, offset0, tolerance, max_drift)
+        else:
+            predicted = offset[seg] + slope[seg]*(bp_t - breaks[seg])
+            bp_idx, oe_idx = _match_events(all_groups, predicted, bp_ty, tolerance)
+        if len(bp_idx) < 2:
+            raise Exception('only ' + str(len(bp_idx)) + ' events matched, increase the tolerance')
+        offset, slope, residuals, used = _fit_segments(bp_t[bp_idx], oe_t[oe_idx], seg[bp_idx], breaks, min_step)
+
+    predicted = offset[seg] + slope[seg]*(bp_t - breaks[seg])
+    matches = pd.DataFrame({"bp_index": bp_pos[bp_idx],
+                            "oe_index": oe_pos[oe_idx],
+                            "bp_ms": bp_t[bp_idx],
+                            "oe_ms": oe_t[oe_idx],
+                            "predicted_ms": predicted[bp_idx],
+                            "residual_ms": residuals,
+                            "type": labels[bp_ty[bp_idx]],
+                            "segment": seg[bp_idx],
+                            "used": used})
+    return ClockModel(breaks, offset, slope, sample_rate, first_sample, matches, len(bp_t), len(oe_t))
+
+def get_clock_model(openephys_dir,pybpod_root,pybpod_session,tolerance=5.,sample_rate=30000.):
+    """clock model from bpod session time (csv ms_relativ) to open ephys samples
+
+    trial starts and ends are matched first, every trial is its own linear segment because
+    the csv trial start times come from the pc clock.
+    """
+    _, states_df, starts, oe_events_df, oe_trials_df = load_sync_events(openephys_dir,pybpod_root,pybpod_session)
+
+    bp_types = np.where(states_df.MSG=='start', 'start', np.where(states_df.MSG=='end_state', 'end', 'event'))
+    oe_types = np.where(oe_trials_df.event_type=='reward_event', 'event', oe_trials_df.event_type)
+    return align_clocks(oe_trials_df.ms_relativ.to_numpy(), states_df.ms_relativ.to_numpy(),
+                        oe_types, bp_types, anchor_types=('start','end'), breaks=starts.to_numpy(dtype=float),
+                        tolerance=tolerance, sample_rate=sample_rate,
+                        first_sample=oe_events_df.samplerate_absolut.iloc[0])
+
+
 
 
 # Plotting =============================================================================================
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Lossless, chunked and compressed long-term storage for Open Ephys .continuous recordings.
+
+A recording folder is split into time x channel chunks of int16 samples. Every chunk is
+delta encoded along time, byte shuffled and compressed with zlib. Record timestamps,
+recording numbers and the headers of all channels are kept as metadata, so the original
+data can be restored exactly.
+
+Usage:
+    import openephys_archive
+    openephys_archive.exportArchive(folderpath)                 # writes folderpath/100_CHs.oearchive
+    archive = openephys_archive.Archive(archivepath)
+    archive[30000:60000, :16]                                   # only the touched chunks are decompressed
+
+"""
+
+import os
+import json
+import time
+import zlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from openephys_fileformat import ContinuousFolder, SAMPLES_PER_RECORD
+
+ARCHIVE_VERSION = 1
+METADATA_FILENAME = 'archive.json'
+DATA_FILENAME = 'chunks.bin'
+OFFSETS_FILENAME = 'offsets.npy'
+
+
+def exportArchive(folderpath, archivepath = '', channels = 'all', chprefix = 'CH', session = '0',
+                  source = '100', chunk_records = 32, chunk_channels = 16, level = 6, workers = 4):
+    '''Convert the continuous files of a recording folder to a compressed archive.
+
+    archivepath:    Output directory, by default e.g. folderpath/100_CHs.oearchive.
+    chunk_records:  Number of records (1024 samples) per chunk along time.
+    chunk_channels: Number of channels per chunk.
+    level:          zlib compression level.
+    workers:        Number of threads used to decode and compress chunks.
+
+    Returns the path of the archive.
+    '''
+
+    recording = ContinuousFolder(folderpath, channels, chprefix, np.int16, session, source)
+
+    if not archivepath:
+        suffix = '' if session == '0' else '_' + session
+        archivepath = os.path.join(folderpath, source + '_' + chprefix + 's' + suffix + '.oearchive')
+    os.makedirs(archivepath, exist_ok = True)
+    print('Archiving data to: ' + archivepath)
+
+    t0 = time.time()
+    n_samples, n_channels = recording.shape
+    chunkSamples = chunk_records * SAMPLES_PER_RECORD
+    timeChunks = -(-n_samples // chunkSamples)
+    channelChunks = -(-n_channels // chunk_channels)
+    offsets = np.zeros((timeChunks, channelChunks, 2), np.int64)
+    position = 0
+
+    with ThreadPoolExecutor(workers) as pool, open(os.path.join(archivepath, DATA_FILENAME), 'wb') as out:
+        for i in range(timeChunks):
+            start = i * chunkSamples
+            data = recording.read(start, min(start + chunkSamples, n_samples), workers = workers)
+            blocks = [data[:, j * chunk_channels:(j + 1) * chunk_channels] for j in range(channelChunks)]
+            for j, compressed in enumerate(pool.map(lambda block: encodeChunk(block, level), blocks)):
+                out.write(compressed)
+                offsets[i, j] = (position, len(compressed))
+                position += len(compressed)
+
+    np.save(os.path.join(archivepath, OFFSETS_FILENAME), offsets)
+    np.save(os.path.join(archivepath, 'timestamps.npy'), recording.timestamps)
+    np.save(os.path.join(archivepath, 'recordingNumber.npy'), recording.files[0].recordingNumber)
+
+    metadata = {'version': ARCHIVE_VERSION,
+                'shape': [n_samples, n_channels],
+                'chunkSamples': chunkSamples,
+                'chunkChannels': chunk_channels,
+                'channels': recording.channels,
+                'filenames': [os.path.basename(f.filepath) for f in recording.files],
+                'headers': [f.header for f in recording.files],
+                'codec': 'delta-shuffle-zlib'}
+    with open(os.path.join(archivepath, METADATA_FILENAME), 'w') as f:
+        json.dump(metadata, f, indent = 4)
+
+    rawBytes = sum(os.path.getsize(f.filepath) for f in recording.files)
+    print(''.join(('Compression ratio: ', str(rawBytes / max(position, 1)))))
+    print(''.join(('Total Archive Time: ', str((time.time() - t0)),' sec')))
+
+    return archivepath
+
+def encodeChunk(block, level = 6):
+    '''Delta encode a [n_samples, n_channels] int16 block along time, byte shuffle and compress.'''
+    data = np.ascontiguousarray(block.T, np.int16)
+    delta = data.copy()
+    delta[:, 1:] -= data[:, :-1]  # wraps around, which the cumulative sum undoes
+    shuffled = delta.view(np.uint8).reshape(-1, 2).T
+    return zlib.compress(shuffled.tobytes(), level)
+
+def decodeChunk(buffer, n_samples, n_channels):
+    '''Inverse of encodeChunk, returns a [n_samples, n_channels] int16 block.'''
+    shuffled = np.frombuffer(zlib.decompress(buffer), np.uint8).reshape(2, -1)
+    delta = np.ascontiguousarray(shuffled.T).view(np.int16).reshape(n_channels, n_samples)
+    return np.cumsum(delta, 1, dtype = np.int16).T
+
+
+class Archive:
+    '''Lazy reader for archives written by exportArchive, with the windowed API of
+    ContinuousFolder. Only the chunks overlapping a window are read and decompressed,
+    on a thread pool of workers threads.
+
+    Usage:
+        archive[30000:60000]                     # all channels, samples 1 s to 2 s
+        archive[30000:60000, :16]                # first 16 channels
+        archive.read(start, stop, out = buffer)  # fill a preallocated buffer
+    '''
+
+    def __init__(self, archivepath, dtype = float, workers = 4):
+
+        assert dtype in (float, np.int16), \
+          'Invalid data type specified for Archive, valid types are float and np.int16'
+
+        self.archivepath = archivepath
+        self.dtype = dtype
+        self.workers = workers
+
+        with open(os.path.join(archivepath, METADATA_FILENAME)) as f:
+            self.metadata = json.load(f)
+        if self.metadata['version'] != ARCHIVE_VERSION:
+            raise Exception('Unsupported archive version ' + str(self.metadata['version']))
+
+        self.channels = self.metadata['channels']
+        self.headers = self.metadata['headers']
+        self.bitVolts = np.array([float(h['bitVolts']) for h in self.headers])
+        self.sampleRate = float(self.headers[0]['sampleRate'])
+        self.offsets = np.load(os.path.join(archivepath, OFFSETS_FILENAME))
+        self.timestamps = np.load(os.path.join(archivepath, 'timestamps.npy'))
+        self.recordingNumber = np.load(os.path.join(archivepath, 'recordingNumber.npy'))
+        self.data = np.memmap(os.path.join(archivepath, DATA_FILENAME), np.uint8, 'r') \
+            if self.offsets[..., 1].sum() else np.zeros(0, np.uint8)
+
+    @property
+    def shape(self):
+        return tuple(self.metadata['shape'])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        samples, chans = key
+        if not isinstance(samples, slice) or samples.step not in (None, 1):
+            raise IndexError('Archive only supports contiguous sample slices')
+        start, stop, _ = samples.indices(len(self))
+        return self.read(start, stop, chans)
+
+    def read(self, start, stop, chans = slice(None), out = None, dtype = None):
+        '''Return samples [start, stop) of the selected channels as a [n_samples, n_channels]
+        array. If out is given, data is written straight into it.'''
+        if dtype is None:
+            dtype = self.dtype
+        n_samples, n_channels = self.shape
+        start = max(start, 0)
+        stop = max(min(stop, n_samples), start)
+        indices = np.atleast_1d(np.arange(n_channels)[chans])
+
+        if out is None:
+            out = np.empty((stop - start, len(indices)), dtype)
+        elif out.shape != (stop - start, len(indices)):
+            raise ValueError('out has shape ' + str(out.shape) + ', expected ' + str((stop - start, len(indices))))
+        if stop == start or len(indices) == 0:
+            return out
+
+        chunkSamples = self.metadata['chunkSamples']
+        chunkChannels = self.metadata['chunkChannels']
+        timeChunks = range(start // chunkSamples, (stop - 1) // chunkSamples + 1)
+        channelChunks = np.unique(indices // chunkChannels)
+
+        def decode(chunk):
+            i, j = chunk
+            offset, length = self.offsets[i, j]
+            rows = min(chunkSamples, n_samples - i * chunkSamples)
+            columns = min(chunkChannels, n_channels - j * chunkChannels)
+            block = decodeChunk(self.data[offset:offset + length].tobytes(), rows, columns)
+
+            # copy the part of the block that overlaps the window into out
+            lo = max(start - i * chunkSamples, 0)
+            hi = min(stop - i * chunkSamples, rows)
+            selected = np.flatnonzero(indices // chunkChannels == j)
+            block = block[lo:hi, indices[selected] - j * chunkChannels]
+            target = slice(i * chunkSamples + lo - start, i * chunkSamples + hi - start)
+            if dtype == float:
+                out[target, selected] = block * self.bitVolts[indices[selected]]
+            else:
+                out[target, selected] = block
+
+        chunks = [(i, j) for i in timeChunks for j in channelChunks]
+        if self.workers == 1:
+            list(map(decode, chunks))
+        else:
+            with ThreadPoolExecutor(self.workers) as pool:
+                list(pool.map(decode, chunks))
+        return out
+
+    def sampleIndex(self, t):
+        '''Sample index of timestamp t, clipped to the samples of the record it falls in.'''
+        record = np.searchsorted(self.timestamps, t, 'right') - 1
+        if record < 0:
+            return 0
+        return record * SAMPLES_PER_RECORD + int(min(t - self.timestamps[record], SAMPLES_PER_RECORD))
+
+    def between(self, t0, t1, chans = slice(None), out = None, dtype = None):
+        '''Return samples with timestamps t0 <= t < t1 of the selected channels.'''
+        return self.read(self.sampleIndex(t0), self.sampleIndex(t1), chans, out, dtype)
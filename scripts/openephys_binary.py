@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Loads recordings saved in the Open Ephys binary format (structure.oebin, continuous.dat
+and .npy event / spike files) without copying them into memory.
+
+Usage:
+    import openephys_binary
+    rec = openephys_binary.BinaryRecording(pathToRecordingFolder)  # e.g. .../experiment1/recording1
+    rec.continuous['Rhythm_FPGA-100.0'][30000:60000]                 # [n_samples, n_channels] in uV
+    rec.events['Rhythm_FPGA-100.0/TTL_1'].between(t0, t1)            # dict of event arrays
+
+"""
+
+import os
+import re
+import json
+import numpy as np
+
+
+def loadRecording(folderpath):
+    return BinaryRecording(folderpath)
+
+def readStructure(folderpath):
+    '''Parse structure.oebin of a recording folder.'''
+    with open(os.path.join(folderpath, 'structure.oebin')) as f:
+        return json.load(f)
+
+def readSyncMessages(folderpath):
+    '''Parse sync_messages.txt of a recording folder.
+
+    Returns a dict with the software start time under 'software' ([time, rate]) and the
+    start sample and sample rate of every processor under '<processor id>_<subprocessor>'.
+    '''
+    messages = { }
+    filepath = os.path.join(folderpath, 'sync_messages.txt')
+    if not os.path.exists(filepath):
+        return messages
+
+    with open(filepath) as f:
+        for line in f:
+            software = re.search(r'Software time:\s*(\d+)@(\d+)Hz', line)
+            processor = re.search(r'Id:\s*(\d+)\s*subProcessor:\s*(\d+)\s*start time:\s*(\d+)@(\d+)Hz', line)
+            if software:
+                messages['software'] = [int(software.group(1)), int(software.group(2))]
+            elif processor:
+                key = processor.group(1) + '_' + processor.group(2)
+                messages[key] = [int(processor.group(3)), int(processor.group(4))]
+    return messages
+
+def _streamName(folderName):
+    return folderName.strip('/')
+
+def _loadNpy(folderpath, name):
+    # memory map a .npy file of a stream, missing files are returned as None
+    filepath = os.path.join(folderpath, name)
+    if not os.path.exists(filepath):
+        return None
+    return np.load(filepath, mmap_mode = 'r')
+
+
+class BinaryRecording:
+    '''All streams of a recording folder (the one that holds structure.oebin).
+
+    continuous, events and spikes are dicts of ContinuousStream, EventStream and SpikeStream,
+    keyed by the stream folder name, e.g. 'Rhythm_FPGA-100.0' or 'Rhythm_FPGA-100.0/TTL_1'.
+    '''
+
+    def __init__(self, folderpath):
+        self.folderpath = folderpath
+        self.structure = readStructure(folderpath)
+        self.syncMessages = readSyncMessages(folderpath)
+
+        self.continuous = { }
+        for info in self.structure.get('continuous', []):
+            streampath = os.path.join(folderpath, 'continuous', info['folder_name'])
+            if not os.path.exists(os.path.join(streampath, 'continuous.dat')):
+                # e.g. recordings that only saved events
+                print('Skipping continuous stream without continuous.dat: ' + streampath)
+                continue
+            self.continuous[_streamName(info['folder_name'])] = ContinuousStream(
+                streampath, info, self._startSample(info))
+
+        self.events = { }
+        for info in self.structure.get('events', []):
+            self.events[_streamName(info['folder_name'])] = EventStream(
+                os.path.join(folderpath, 'events', info['folder_name']), info)
+
+        self.spikes = { }
+        for info in self.structure.get('spikes', []):
+            self.spikes[_streamName(info['folder_name'])] = SpikeStream(
+                os.path.join(folderpath, 'spikes', info['folder_name']), info)
+
+    def _startSample(self, info):
+        key = str(info.get('source_processor_id')) + '_' + str(info.get('source_processor_sub_idx'))
+        if key in self.syncMessages:
+            return self.syncMessages[key][0]
+        return None
+
+
+class ContinuousStream:
+    '''Lazy view of the continuous.dat of one stream, memory mapped as [n_samples, n_channels]
+    int16. Samples are only scaled by the per channel bit_volts for the window that is read.
+
+    Usage:
+        stream[30000:60000]                     # all channels, samples 1 s to 2 s
+        stream[30000:60000, :16]                # first 16 channels
+        stream.between(t0, t1)                  # samples with timestamps t0 <= t < t1
+        stream.read(start, stop, out = buffer)  # fill a preallocated buffer
+    '''
+
+    def __init__(self, folderpath, info, startSample = None, dtype = float):
+
+        assert dtype in (float, np.int16), \
+          'Invalid data type specified for ContinuousStream, valid types are float and np.int16'
+
+        self.folderpath = folderpath
+        self.info = info
+        self.dtype = dtype
+        self.sampleRate = float(info['sample_rate'])
+        self.numChannels = int(info['num_channels'])
+        self.channelNames = [ch['channel_name'] for ch in info['channels']]
+        self.bitVolts = np.array([float(ch['bit_volts']) for ch in info['channels']])
+
+        filepath = os.path.join(folderpath, 'continuous.dat')
+        n_samples = os.path.getsize(filepath) // (2 * self.numChannels)
+        self.data = np.memmap(filepath, np.int16, 'r', shape = (n_samples, self.numChannels))
+
+        self._timestamps = _loadNpy(folderpath, 'timestamps.npy')
+        self.startSample = startSample
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def timestamps(self):
+        '''Timestamp of every sample, derived from the start sample if timestamps.npy is missing.'''
+        if self._timestamps is None:
+            start = self.startSample if self.startSample is not None else 0
+            self._timestamps = np.arange(start, start + len(self), dtype = np.int64)
+        return self._timestamps
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        samples, chans = key
+        if not isinstance(samples, slice) or samples.step not in (None, 1):
+            raise IndexError('ContinuousStream only supports contiguous sample slices')
+        start, stop, _ = samples.indices(len(self))
+        return self.read(start, stop, chans)
+
+    def read(self, start, stop, chans = slice(None), out = None, dtype = None):
+        '''Return samples [start, stop) of the selected channels as a [n_samples, n_channels]
+        array. If out is given, data is written straight into it.'''
+        if dtype is None:
+            dtype = self.dtype
+        start = max(start, 0)
+        stop = max(min(stop, len(self)), start)
+        indices = np.atleast_1d(np.arange(self.numChannels)[chans])
+        window = self.data[start:stop]
+        if not np.array_equal(indices, np.arange(self.numChannels)):
+            window = window[:, indices]
+
+        if out is None:
+            out = np.empty((stop - start, len(indices)), dtype)
+        if dtype == float:
+            np.multiply(window, self.bitVolts[indices], out = out)
+        else:
+            out[...] = window
+        return out
+
+    def sampleIndex(self, t):
+        '''Index of the first sample with a timestamp >= t.'''
+        return int(np.searchsorted(self.timestamps, t, 'left'))
+
+    def between(self, t0, t1, chans = slice(None), out = None, dtype = None):
+        '''Return samples with timestamps t0 <= t < t1 of the selected channels.'''
+        return self.read(self.sampleIndex(t0), self.sampleIndex(t1), chans, out, dtype)
+
+
+class EventStream:
+    '''Memory mapped .npy files of one event stream (e.g. TTL_1 or TEXT_group_1).
+
+    fields holds every array of the stream folder by file name, e.g. 'timestamps', 'channels',
+    'channel_states', 'full_words' for TTL and 'text' for message events.
+    '''
+
+    FIELDS = ('timestamps', 'channels', 'channel_states', 'full_words', 'text')
+
+    def __init__(self, folderpath, info):
+        self.folderpath = folderpath
+        self.info = info
+        self.sampleRate = float(info['sample_rate']) if 'sample_rate' in info else None
+        self.fields = { }
+        for name in self.FIELDS:
+            array = _loadNpy(folderpath, name + '.npy')
+            if array is not None:
+                self.fields[name] = array
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, name):
+        return self.fields[name]
+
+    @property
+    def timestamps(self):
+        return self.fields['timestamps']
+
+    def between(self, t0, t1):
+        '''Return all fields of the events with timestamps t0 <= t < t1.'''
+        first, last = np.searchsorted(self.timestamps, [t0, t1], 'left')
+        return {name: np.array(array[first:last]) for name, array in self.fields.items()}
+
+
+class SpikeStream(EventStream):
+    '''Memory mapped .npy files of one spike stream.'''
+
+    FIELDS = ('spike_times', 'spike_waveforms', 'spike_electrode_indices', 'spike_clusters')
+
+    @property
+    def timestamps(self):
+        return self.fields['spike_times']
@@ -13,12 +13,13 @@ Usage:
 """
 
 import os
+import bisect
 import numpy as np
 import scipy.signal
 import scipy.io
 import time
-import struct
-from copy import deepcopy
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 # constants
 NUM_HEADER_BYTES = 1024
@@ -27,6 +28,43 @@ BYTES_PER_SAMPLE = 2
 RECORD_SIZE = 4 + 8 + SAMPLES_PER_RECORD * BYTES_PER_SAMPLE + 10 # size of each continuous record in bytes
 RECORD_MARKER = np.array([0, 1, 2, 3, 4, 5, 6, 7, 8, 255])
 
+# layout of a single continuous record, used to parse all records of a file at once
+RECORD_DTYPE = np.dtype([('timestamp', '<i8'),                           # little-endian 64-bit signed integer
+                         ('N', '<u2'),                                   # little-endian 16-bit unsigned integer
+                         ('recordingNumber', '>u2'),                     # big-endian 16-bit unsigned integer
+                         ('samples', '>i2', SAMPLES_PER_RECORD),         # big-endian 16-bit signed integer
+                         ('marker', '<u1', len(RECORD_MARKER))])
+
+# layout of the fixed size start of a spike record, see spikeRecordDtype for the full record
+SPIKE_HEADER_DTYPE = np.dtype([('eventType', '<u1'),   # always equal to 4
+                               ('timestamp', '<i8'),
+                               ('softwareTimestamp', '<i8'),
+                               ('source', '<u2'),
+                               ('numChannels', '<u2'),
+                               ('numSamples', '<u2'),
+                               ('sortedId', '<u2'),
+                               ('electrodeId', '<u2'),
+                               ('channel', '<u2'),
+                               ('color', '<u1', 3),
+                               ('pcProj', '<f4', 2),
+                               ('sampleFreq', '<u2')])
+
+# layout of a single record of a .events file
+EVENT_DTYPE = np.dtype([('timestamp', '<i8'),
+                        ('sampleNum', '<i2'),
+                        ('eventType', '<u1'),
+                        ('nodeId', '<u1'),
+                        ('eventId', '<u1'),
+                        ('channel', '<u1'),
+                        ('recordingNumber', '<u2')])
+
+# name of the per recording index file, see loadIndex
+INDEX_FILENAME = '.openephys_index.json'
+INDEX_VERSION = 2
+
+# name of the integrity report written by scanFolder
+REPORT_FILENAME = 'continuous_scan.json'
+
 # constants for pre-allocating matrices:
 MAX_NUMBER_OF_SPIKES = int(1e6)
 MAX_NUMBER_OF_RECORDS = int(1e6)
@@ -46,9 +84,10 @@ def load(filepath, dtype = float):
 
     return data
 
-def loadFolder(folderpath, dtype = float, **kwargs):
+def loadFolder(folderpath, dtype = float, workers = 1, **kwargs):
 
     # load all continuous files in a folder
+    # workers: number of threads used to load channels in parallel
 
     data = { }
 
@@ -56,15 +95,15 @@ def loadFolder(folderpath, dtype = float, **kwargs):
     if 'channels' in kwargs.keys():
         filelist = ['100_CH'+x+'.continuous' for x in map(str,kwargs['channels'])]
     else:
-        filelist = os.listdir(folderpath)
+        filelist = sorted(loadIndex(folderpath, [])['files'])
+    filelist = [f for f in filelist if '.continuous' in f]
 
     t0 = time.time()
-    numFiles = 0
+    numFiles = len(filelist)
 
-    for i, f in enumerate(filelist):
-        if '.continuous' in f:
-            data[f.replace('.continuous','')] = loadContinuous(os.path.join(folderpath, f), dtype = dtype)
-            numFiles += 1
+    channels = _map(lambda f: loadContinuous(os.path.join(folderpath, f), dtype = dtype), filelist, workers)
+    for f, ch in zip(filelist, channels):
+        data[f.replace('.continuous','')] = ch
 
     print(''.join(('Avg. Load Time: ', str((time.time() - t0)/numFiles),' sec')))
     print(''.join(('Total Load Time: ', str((time.time() - t0)),' sec')))
@@ -72,43 +111,57 @@ def loadFolder(folderpath, dtype = float, **kwargs):
     return data
 
 def loadFolderToArray(folderpath, channels = 'all', chprefix = 'CH',
-                      dtype = float, session = '0', source = '100'):
+                      dtype = float, session = '0', source = '100', workers = 1, bad = 'raise'):
     '''Load continuous files in specified folder to a single numpy array. By default all
     CH continous files are loaded in numerical order, ordering can be specified with
-    optional channels argument which should be a list of channel numbers.'''
+    optional channels argument which should be a list of channel numbers.
+
+    workers: number of threads used to decode channels in parallel, each channel is
+             decoded straight into its column of the preallocated output array.
+
+    bad:     'raise' on corrupted records, or 'zero' to zero-fill them and drop a truncated
+             final record (see scanFolder).'''
 
     if channels == 'all':
         channels = _get_sorted_channels(folderpath, chprefix, session, source)
 
-    if session == '0':
-        filelist = [source + '_'+chprefix + x + '.continuous' for x in map(str,channels)]
-    else:
-        filelist = [source + '_'+chprefix + x + '_' + session + '.continuous' for x in map(str,channels)]
+    filelist = _get_filelist(channels, chprefix, session, source)
 
     t0 = time.time()
-    numFiles = 1
+    numFiles = len(filelist)
 
-    channel_1_data = loadContinuous(os.path.join(folderpath, filelist[0]), dtype)['data']
+    files = _openChannels(folderpath, filelist, dtype, bad)
 
-    n_samples  = len(channel_1_data)
-    n_channels = len(filelist)
+    n_samples  = len(files[0])
+    n_channels = len(files)
 
     data_array = np.zeros([n_samples, n_channels], dtype)
-    data_array[:,0] = channel_1_data
 
-    for i, f in enumerate(filelist[1:]):
-            data_array[:, i + 1] = loadContinuous(os.path.join(folderpath, f), dtype)['data']
-            numFiles += 1
+    def load_column(i):
+        print("Loading continuous data...")
+        if len(files[i]) != n_samples:
+            raise Exception("Channel " + filelist[i] + " has a different length than " + filelist[0])
+        if bad == 'raise':
+            badRecords = findBadRecords(files[i].records)
+            if len(badRecords):
+                raise Exception('Found corrupted records in ' + filelist[i] + ' blocks ' + str(badRecords.tolist()))
+        files[i].read(0, n_samples, data_array[:, i])
+
+    _map(load_column, range(n_channels), workers)
 
     print(''.join(('Avg. Load Time: ', str((time.time() - t0)/numFiles),' sec')))
     print(''.join(('Total Load Time: ', str((time.time() - t0)),' sec')))
 
     return data_array
 
-def loadContinuous(filepath, dtype = float):
+def loadContinuous(filepath, dtype = float, bad = 'raise'):
+
+    # bad: what to do with corrupted records (wrong N field or record marker) and a truncated
+    #      final record: 'raise', 'skip' them or 'zero' fill their samples. see scanFolder
 
     assert dtype in (float, np.int16), \
       'Invalid data type specified for loadContinous, valid types are float and np.int16'
+    assert bad in ('raise', 'skip', 'zero'), "bad has to be 'raise', 'skip' or 'zero'"
 
     print("Loading continuous data...")
 
@@ -122,54 +175,734 @@ def loadContinuous(filepath, dtype = float):
     # calculate number of samples
     recordBytes = fileLength - NUM_HEADER_BYTES
     if  recordBytes % RECORD_SIZE != 0:
-        raise Exception("File size is not consistent with a continuous file: may be corrupt")
+        if bad == 'raise':
+            raise Exception("File size is not consistent with a continuous file: may be corrupt")
+        print('Dropping truncated final record')
     nrec = recordBytes // RECORD_SIZE
-    nsamp = nrec * SAMPLES_PER_RECORD
-    # pre-allocate samples
-    samples = np.zeros(nsamp, dtype)
-    timestamps = np.zeros(nrec)
-    recordingNumbers = np.zeros(nrec)
-    indices = np.arange(0, nsamp + 1, SAMPLES_PER_RECORD, np.dtype(np.int64))
 
     header = readHeader(f)
 
-    recIndices = np.arange(0, nrec)
+    # read all records in one call, each record is parsed by RECORD_DTYPE
+    records = np.fromfile(f, RECORD_DTYPE, nrec)
+    f.close()
 
-    for recordNumber in recIndices:
+    badRecords = findBadRecords(records)
+    if len(badRecords):
+        if bad == 'raise':
+            raise Exception('Found corrupted records in blocks ' + str(badRecords.tolist()))
+        print(''.join(('Found corrupted records in blocks ', str(badRecords.tolist()), ', ',
+                       'skipping them' if bad == 'skip' else 'zero-filling them')))
+        if bad == 'skip':
+            records = np.delete(records, badRecords)
+        else:
+            records['samples'][badRecords] = 0
 
-        timestamps[recordNumber] = np.fromfile(f,np.dtype('<i8'),1) # little-endian 64-bit signed integer
-        N = np.fromfile(f,np.dtype('<u2'),1)[0] # little-endian 16-bit unsigned integer
+    if dtype == float: # Convert data to float array and convert bits to voltage.
+        samples = records['samples'].ravel() * float(header['bitVolts'])
+    else:  # Keep data in signed 16 bit integer format.
+        samples = records['samples'].ravel().astype(np.int16)
 
-        #print index
+    ch['header'] = header
+    ch['timestamps'] = records['timestamp'].astype(float)
+    ch['data'] = samples  # OR use downsample(samples,1), to save space
+    ch['recordingNumber'] = records['recordingNumber'].astype(float)
+    return ch
 
-        if N != SAMPLES_PER_RECORD:
-            raise Exception('Found corrupted record in block ' + str(recordNumber))
+def scanFolder(folderpath, workers = 8, report = REPORT_FILENAME):
+    '''Check every .continuous file in a folder for corruption, in parallel.
 
-        recordingNumbers[recordNumber] = (np.fromfile(f,np.dtype('>u2'),1)) # big-endian 16-bit unsigned integer
+    Per file it reports a truncated final record (trailingBytes), records with a wrong N
+    field or record marker (badRecords), timestamps that do not increase within a recording
+    (nonMonotonic), gaps between records (gaps) and the records at which the recording number
+    changes (recordingBoundaries). Files with problems can still be loaded with bad='zero'
+    (or bad='skip' for loadContinuous).
 
-        if dtype == float: # Convert data to float array and convert bits to voltage.
-            data = np.fromfile(f,np.dtype('>i2'),N) * float(header['bitVolts']) # big-endian 16-bit signed integer, multiplied by bitVolts
-        else:  # Keep data in signed 16 bit integer format.
-            data = np.fromfile(f,np.dtype('>i2'),N)  # big-endian 16-bit signed integer
-        samples[indices[recordNumber]:indices[recordNumber+1]] = data
+    report: Name of the JSON report written into the folder, None to not write one.
 
-        marker = f.read(10) # dump
+    Returns the report as a dict keyed by file name.
+    '''
 
-    #print recordNumber
-    #print index
+    t0 = time.time()
+    filelist = sorted(f for f in os.listdir(folderpath) if f.endswith('.continuous'))
+    results = _map(lambda f: scanContinuous(os.path.join(folderpath, f)), filelist, workers)
+    scan = dict(zip(filelist, results))
+
+    for f, result in scan.items():
+        if not result['ok']:
+            print(''.join((f, ': ', str(len(result['badRecords'])), ' bad records, ',
+                           str(result['trailingBytes']), ' trailing bytes, ',
+                           str(len(result['nonMonotonic'])), ' non monotonic timestamps')))
+    print(''.join(('Scanned ', str(len(scan)), ' files, ', str(sum(not r['ok'] for r in scan.values())),
+                   ' with problems in ', str((time.time() - t0)), ' sec')))
+
+    if report:
+        try:
+            with open(os.path.join(folderpath, report), 'w') as f:
+                json.dump(scan, f, indent = 4)
+        except OSError:
+            pass
+    return scan
+
+def scanContinuous(filepath):
+    '''Integrity check of a single .continuous file, see scanFolder.'''
+    fileLength = os.path.getsize(filepath)
+    recordBytes = max(fileLength - NUM_HEADER_BYTES, 0)
+    nrec = recordBytes // RECORD_SIZE
+    result = {'nrec': nrec, 'trailingBytes': recordBytes % RECORD_SIZE, 'badRecords': [],
+              'nonMonotonic': [], 'gaps': [], 'recordingBoundaries': [], 'recordingNumbers': []}
+
+    if nrec > 0:
+        records = np.memmap(filepath, RECORD_DTYPE, 'r', NUM_HEADER_BYTES, (nrec,))
+        timestamps = np.array(records['timestamp'])
+        recordingNumber = np.array(records['recordingNumber'])
+        boundaries = np.concatenate(([0], np.flatnonzero(np.diff(recordingNumber)) + 1))
+        sameRecording = np.diff(recordingNumber) == 0
+        steps = np.diff(timestamps)
+        result['badRecords'] = findBadRecords(records).tolist()
+        result['nonMonotonic'] = (np.flatnonzero(sameRecording & (steps <= 0)) + 1).tolist()
+        result['gaps'] = (np.flatnonzero(sameRecording & (steps > SAMPLES_PER_RECORD)) + 1).tolist()
+        result['recordingBoundaries'] = boundaries.tolist()
+        result['recordingNumbers'] = recordingNumber[boundaries].tolist()
+        del records
+
+    result['ok'] = not (result['trailingBytes'] or result['badRecords'] or result['nonMonotonic'])
+    return result
+
+def findBadRecords(records):
+    '''Return the indices of all records whose N field or record marker is not valid.
+    records must be a structured array (or memmap) of RECORD_DTYPE.'''
+
+    bad = records['N'] != SAMPLES_PER_RECORD
+    bad |= np.any(records['marker'] != RECORD_MARKER, axis=1)
+    return np.flatnonzero(bad)
+
+class ContinuousFile:
+    '''Lazy, memory-mapped view of a single .continuous file. Nothing but the header is
+    read on construction, samples are only decoded for the records a slice touches.
+
+    dtype:  float returns voltages scaled by bitVolts, np.int16 returns the raw samples.
+    info:   Optional entry of the file in the recording index (see loadIndex).
+    bad:    'raise' if the file size is not a whole number of records or a read touches a record
+            with a wrong N field or marker, 'zero' drops a truncated final record and zero-fills
+            those records when read.
+
+    Usage:
+        ch = ContinuousFile(pathToFile)
+        ch[30000:60000]            # samples 1 s to 2 s
+        ch.between(t0, t1)         # samples with timestamps t0 <= t < t1
+    '''
 
-    ch['header'] = header
-    ch['timestamps'] = timestamps
-    ch['data'] = samples  # OR use downsample(samples,1), to save space
-    ch['recordingNumber'] = recordingNumbers
-    f.close()
-    return ch
+    def __init__(self, filepath, dtype = float, info = None, bad = 'raise'):
+
+        assert dtype in (float, np.int16), \
+          'Invalid data type specified for ContinuousFile, valid types are float and np.int16'
+        assert bad in ('raise', 'zero'), "bad has to be 'raise' or 'zero'"
+
+        self.filepath = filepath
+        self.dtype = dtype
+        self.bad = bad
+
+        # info is the entry of the file in the recording index, it saves reading the header
+        if info is not None:
+            self.header = info['header']
+            fileLength = info['size']
+        else:
+            with open(filepath, 'rb') as f:
+                fileLength = os.fstat(f.fileno()).st_size
+                self.header = readHeader(f)
+
+        recordBytes = fileLength - NUM_HEADER_BYTES
+        if  recordBytes % RECORD_SIZE != 0 and bad == 'raise':
+            raise Exception("File size is not consistent with a continuous file: may be corrupt")
+        self.nrec = recordBytes // RECORD_SIZE
+
+        self.bitVolts = float(self.header['bitVolts'])
+        self.sampleRate = float(self.header['sampleRate'])
+        self.records = np.memmap(filepath, RECORD_DTYPE, 'r', NUM_HEADER_BYTES, (self.nrec,))
+        self.info = info
+        self._timestamps = None
+        self._recordingBoundaries = None
+
+    @property
+    def shape(self):
+        return (self.nrec * SAMPLES_PER_RECORD,)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def timestamps(self):
+        '''Start timestamp of every record.'''
+        if self._timestamps is None:
+            self._timestamps = np.array(self.records['timestamp'])
+        return self._timestamps
+
+    @property
+    def recordingNumber(self):
+        return np.array(self.records['recordingNumber'])
+
+    def searchTimestamps(self, t, side = 'right', lo = 0, hi = None):
+        '''Record index t would be inserted at among the record timestamps of [lo, hi), as
+        np.searchsorted. t may be a scalar or an array. Unless all timestamps were already
+        loaded, this is a binary search over the memory mapped records, which only reads
+        the few records it compares with. So many values that the searches would touch more
+        records than the file has load all timestamps instead.'''
+        if hi is None:
+            hi = self.nrec
+        if self._timestamps is None and np.size(t) * np.log2(max(hi - lo, 2)) > self.nrec:
+            self.timestamps
+        if self._timestamps is not None:
+            return lo + np.searchsorted(self._timestamps[lo:hi], t, side)
+        search = bisect.bisect_right if side == 'right' else bisect.bisect_left
+        timestamps = self.records['timestamp']
+        if np.ndim(t) == 0:
+            return search(timestamps, t, lo, hi)
+        return np.array([search(timestamps, v, lo, hi) for v in np.ravel(t)], np.int64).reshape(np.shape(t))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            indices = range(*key.indices(len(self)))
+            if len(indices) == 0:
+                return np.zeros(0, self.dtype)
+            first = min(indices[0], indices[-1])
+            samples = self.read(first, max(indices[0], indices[-1]) + 1)
+            return samples[indices[0] - first::indices.step][:len(indices)]
+        index = int(key)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('sample index out of range')
+        return self.read(index, index + 1)[0]
+
+    def read(self, start, stop, out = None, dtype = None):
+        '''Decode samples [start, stop), only touching the records that hold them.
+
+        out:   optional preallocated array (e.g. a column of a larger array) the samples
+               are written into instead of allocating a new one.
+        dtype: float or np.int16, overrides the dtype the file was opened with.
+        '''
+        if dtype is None:
+            dtype = self.dtype
+        start = max(start, 0)
+        stop = min(stop, len(self))
+        if stop <= start:
+            return np.zeros(0, dtype) if out is None else out[:0]
+
+        firstRecord = start // SAMPLES_PER_RECORD
+        lastRecord = (stop - 1) // SAMPLES_PER_RECORD + 1
+        offset = firstRecord * SAMPLES_PER_RECORD
+        samples = self.records['samples'][firstRecord:lastRecord].ravel()[start - offset:stop - offset]
+
+        if out is None:
+            out = np.empty(len(samples), dtype)
+        if dtype == float:
+            np.multiply(samples, self.bitVolts, out = out)
+        else:
+            out[...] = samples
+
+        badRecords = self._checkRecords(firstRecord, lastRecord)
+        for record in badRecords:
+            lo = max(record * SAMPLES_PER_RECORD, start) - start
+            hi = min((record + 1) * SAMPLES_PER_RECORD, stop) - start
+            out[lo:hi] = 0
+        return out
+
+    def _checkRecords(self, first, last):
+        # corrupted records among [first, last), raises for bad == 'raise'
+        badRecords = findBadRecords(self.records[first:last]) + first
+        if len(badRecords) and self.bad == 'raise':
+            raise Exception('Found corrupted records in ' + self.filepath + ' blocks ' + str(badRecords.tolist()))
+        return badRecords
+
+    def sampleIndex(self, t):
+        '''Sample index of timestamp t, clipped to the samples of the record it falls in.'''
+        record = self.searchTimestamps(t, 'right') - 1
+        if record < 0:
+            return 0
+        return record * SAMPLES_PER_RECORD + int(min(t - self.records['timestamp'][record], SAMPLES_PER_RECORD))
+
+    def between(self, t0, t1):
+        '''Return all samples with timestamps t0 <= t < t1 (in timestamp units, i.e. samples).'''
+        return self.read(self.sampleIndex(t0), self.sampleIndex(t1))
+
+    @property
+    def recordingBoundaries(self):
+        '''First record of every recording (recording number change) in the file.
+
+        Recording numbers only increase within a file, so the changes are found by bisection
+        over the memory mapped records, only a few records per recording are read. scanFolder
+        checks the recording numbers of every record.
+        '''
+        if self._recordingBoundaries is None:
+            recordingNumber = self.records['recordingNumber']
+            boundaries = [0] if self.nrec else []
+            pending = [(0, self.nrec - 1)] if self.nrec else []
+            while pending:
+                lo, hi = pending.pop()
+                if recordingNumber[lo] == recordingNumber[hi]:
+                    continue
+                if hi - lo == 1:
+                    boundaries.append(hi)
+                    continue
+                mid = (lo + hi) // 2
+                pending += [(lo, mid), (mid, hi)]
+            self._recordingBoundaries = sorted(boundaries)
+        return list(self._recordingBoundaries)
+
+    def recordRange(self, t_start, t_end, recording = None):
+        '''Records [first, last) that overlap the timestamps t_start <= t < t_end, found by a
+        binary search over the record timestamps of a single recording.
+
+        Timestamps are only monotonic within a recording. If the file holds several recordings
+        and recording is None, the range has to fall into exactly one of them, otherwise an
+        exception is raised. recording is the index of a recording in recordingBoundaries.
+        '''
+        boundaries = self.recordingBoundaries + [self.nrec]
+        segments = range(len(boundaries) - 1) if recording is None else [recording]
+
+        timestamps = self.records['timestamp']
+        hits = []
+        for segment in segments:
+            lo, hi = boundaries[segment], boundaries[segment + 1]
+            first = max(self.searchTimestamps(t_start, 'right', lo, hi) - 1, lo)
+            if first < hi and timestamps[first] + SAMPLES_PER_RECORD <= t_start:
+                first += 1
+            last = self.searchTimestamps(t_end, 'left', lo, hi)
+            if first < last:
+                hits.append((first, last))
+
+        if len(hits) > 1:
+            raise Exception('Time range ' + str((t_start, t_end)) + ' spans ' + str(len(hits)) +
+                            ' recordings, specify recording')
+        return hits[0] if hits else (0, 0)
+
+    def read_range(self, t_start, t_end, out = None, dtype = None, gaps = 'fill', fill = None, recording = None):
+        '''Return exactly t_end - t_start samples with timestamps t_start <= t < t_end.
+
+        Only the records overlapping the range are read. Samples missing because of gaps in
+        the record timestamps (or outside the file) are set to fill (NaN for float, 0 for
+        int16), or raise an exception if gaps is 'raise'. See recordRange for recording.
+        '''
+        if dtype is None:
+            dtype = self.dtype
+        positions, first, last = self._rangePositions(t_start, t_end, gaps, recording)
+        if out is None:
+            out = np.empty(t_end - t_start, dtype)
+        self._scatter(positions, first, last, out, dtype, fill)
+        return out
+
+    def _rangePositions(self, t_start, t_end, gaps, recording):
+        # position of every sample of the overlapping records in the output window
+        first, last = self.recordRange(t_start, t_end, recording)
+        positions = (np.array(self.records['timestamp'][first:last]) - t_start)[:, None] + np.arange(SAMPLES_PER_RECORD)
+        if gaps == 'raise':
+            covered = np.count_nonzero((positions >= 0) & (positions < t_end - t_start))
+            if covered != t_end - t_start:
+                raise Exception('Time range ' + str((t_start, t_end)) + ' is missing ' +
+                                str(t_end - t_start - covered) + ' samples')
+        return positions, first, last
+
+    def gather(self, indices, dtype = None):
+        '''Decode the samples at the sample indices (any shape), reading only the records
+        that hold them.'''
+        if dtype is None:
+            dtype = self.dtype
+        records = indices // SAMPLES_PER_RECORD
+        if self.bad == 'raise':
+            touched = np.unique(records)
+            badRecords = touched[findBadRecords(self.records[touched])]
+            if len(badRecords):
+                raise Exception('Found corrupted records in ' + self.filepath + ' blocks ' + str(badRecords.tolist()))
+        samples = self.records['samples'][records, indices % SAMPLES_PER_RECORD]
+        if dtype == float:
+            return samples * self.bitVolts
+        return samples.astype(np.int16)
+
+    def _scatter(self, positions, first, last, out, dtype, fill):
+        if fill is None:
+            fill = np.nan if dtype == float else 0
+        out[...] = fill
+        if self.bad == 'raise':
+            self._checkRecords(first, last)
+        valid = (positions >= 0) & (positions < len(out))
+        samples = self.records['samples'][first:last][valid]
+        if dtype == float:
+            out[positions[valid]] = samples * self.bitVolts
+        else:
+            out[positions[valid]] = samples
+
+class ContinuousFolder:
+    '''Lazy view of all continuous files of a recording in a folder. Every channel is
+    opened as a ContinuousFile, windows of [n_samples, n_channels] are only read on demand.
+    Channel selection and ordering follows loadFolderToArray.
+
+    Usage:
+        rec = ContinuousFolder(folderpath)
+        rec[30000:60000]                     # all channels, samples 1 s to 2 s
+        rec[30000:60000, :16]                # first 16 channels
+        rec.read(start, stop, out = buffer)  # fill a preallocated [n, n_channels] buffer
+
+    dref: Optional digital reference applied to every window that is read, see digitalReference.
+          A reference channel that is not among channels is opened next to them.
+    bad:  'raise' or 'zero', handling of corrupted records, see ContinuousFile.
+    '''
+
+    def __init__(self, folderpath, channels = 'all', chprefix = 'CH',
+                 dtype = float, session = '0', source = '100', dref = None, bad = 'raise'):
+
+        if channels == 'all':
+            channels = _get_sorted_channels(folderpath, chprefix, session, source)
+
+        self.folderpath = folderpath
+        self.channels = list(channels)
+        self.dtype = dtype
+        self.dref = dref
+        self.files = _openChannels(folderpath, _get_filelist(channels, chprefix, session, source), dtype, bad)
+
+        # files and channel numbers decoded for digital referencing, plus the reference channel
+        # if it is not one of the channels
+        self._referenceFiles = list(self.files)
+        self._referenceChannels = list(self.channels)
+        if dref is not None and dref not in ('ave', 'med') and dref not in self.channels:
+            self._referenceFiles += _openChannels(folderpath, _get_filelist([dref], chprefix, session, source), dtype, bad)
+            self._referenceChannels.append(dref)
+
+        lengths = set(len(f) for f in self._referenceFiles)
+        if len(lengths) > 1:
+            raise Exception("Continuous files in folder have different lengths: " + str(sorted(lengths)))
+
+    @property
+    def shape(self):
+        return (len(self.files[0]), len(self.files))
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def timestamps(self):
+        return self.files[0].timestamps
+
+    @property
+    def sampleRate(self):
+        return self.files[0].sampleRate
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        samples, chans = key
+        if not isinstance(samples, slice) or samples.step not in (None, 1):
+            raise IndexError('ContinuousFolder only supports contiguous sample slices')
+        start, stop, _ = samples.indices(len(self))
+        return self.read(start, stop, chans = chans)
+
+    def read(self, start, stop, chans = slice(None), out = None, dtype = None, workers = 1):
+        '''Return samples [start, stop) of the selected channels as a [n_samples, n_channels]
+        array. If out is given, data is decoded straight into it and nothing else is allocated.
+        workers sets the number of threads the channels are decoded on.'''
+        if dtype is None:
+            dtype = self.dtype
+        start = max(start, 0)
+        stop = max(min(stop, len(self)), start)
+        indices = np.atleast_1d(np.arange(len(self.files))[chans])
+
+        if out is None:
+            out = np.empty((stop - start, len(indices)), dtype)
+        elif out.shape != (stop - start, len(indices)):
+            raise ValueError('out has shape ' + str(out.shape) + ', expected ' + str((stop - start, len(indices))))
+
+        if self.dref is None:
+            _map(lambda i: self.files[indices[i]].read(start, stop, out[:, i], dtype), range(len(indices)), workers)
+            return out
+
+        # the reference depends on all channels, decode all of them before selecting
+        files = self._referenceFiles
+        allChannels = np.array_equal(indices, np.arange(len(files)))
+        data = out if allChannels else np.empty((stop - start, len(files)), dtype)
+        _map(lambda i: files[i].read(start, stop, data[:, i], dtype), range(len(files)), workers)
+        digitalReference(data, self.dref, self._referenceChannels)
+        if not allChannels:
+            out[...] = data[:, indices]
+        return out
+
+    def between(self, t0, t1, chans = slice(None), out = None, dtype = None, workers = 1):
+        '''Return samples with timestamps t0 <= t < t1 of the selected channels.'''
+        first = self.files[0]
+        return self.read(first.sampleIndex(t0), first.sampleIndex(t1), chans, out, dtype, workers)
+
+    def read_range(self, channels, t_start, t_end, out = None, dtype = None, gaps = 'fill',
+                   fill = None, recording = None, workers = 1):
+        '''Return a [t_end - t_start, n_channels] window of the samples with timestamps
+        t_start <= t < t_end, reading only the records that overlap it.
+
+        channels:  List of channel numbers (as in self.channels) or 'all'.
+        gaps:      'fill' sets missing samples to fill (NaN for float, 0 for int16),
+                   'raise' raises an exception if the range is not fully covered.
+        recording: Index of the recording (recording number segment) to search in, required
+                   if the range overlaps several recordings.
+
+        The record layout is taken from the first channel, digital referencing is applied
+        when the folder was opened with dref.
+        '''
+        if dtype is None:
+            dtype = self.dtype
+        if channels == 'all':
+            channels = self.channels
+        indices = [self.channels.index(ch) for ch in channels]
+        positions, first, last = self.files[0]._rangePositions(t_start, t_end, gaps, recording)
+
+        if out is None:
+            out = np.empty((t_end - t_start, len(indices)), dtype)
+        elif out.shape != (t_end - t_start, len(indices)):
+            raise ValueError('out has shape ' + str(out.shape) + ', expected ' + str((t_end - t_start, len(indices))))
+
+        if self.dref is None:
+            _map(lambda i: self.files[indices[i]]._scatter(positions, first, last, out[:, i], dtype, fill),
+                 range(len(indices)), workers)
+            return out
+
+        files = self._referenceFiles
+        data = np.empty((t_end - t_start, len(files)), dtype)
+        _map(lambda i: files[i]._scatter(positions, first, last, data[:, i], dtype, fill),
+             range(len(files)), workers)
+        digitalReference(data, self.dref, self._referenceChannels)
+        out[...] = data[:, indices]
+        return out
+
+def loadIndex(folderpath, filelist = None):
+    '''Return the index of the continuous files of a recording folder.
+
+    The index is stored as INDEX_FILENAME next to the recording and holds, per file, the
+    header, number of records and first and last timestamp, plus the sorted channel lists
+    per source and session. Only the header and the first and last record of a file are read.
+
+    filelist: Files whose entries are brought up to date, by default all files. Entries of
+              files that were never indexed are None, [] only refreshes the file list.
+
+    Entries are refreshed when the size or modification time of a file changes, the file
+    list is refreshed when the modification time of the folder changes.
+    '''
+
+    indexpath = os.path.join(folderpath, INDEX_FILENAME)
+    index = None
+    if os.path.exists(indexpath):
+        try:
+            with open(indexpath) as f:
+                index = json.load(f)
+            if index.get('version') != INDEX_VERSION:
+                index = None
+        except ValueError:
+            index = None
+    if index is None:
+        index = {'version': INDEX_VERSION, 'mtime': None, 'files': { }, 'channels': { }}
+
+    changed = False
+    mtime = os.stat(folderpath).st_mtime_ns
+    if index['mtime'] != mtime:
+        listing = [f for f in os.listdir(folderpath) if f.endswith('.continuous')]
+        if sorted(listing) != sorted(index['files']):
+            index['files'] = {f: index['files'][f] for f in listing if f in index['files']}
+            index['channels'] = { }
+        for f in listing:
+            index['files'].setdefault(f, None)
+        index['mtime'] = mtime
+        changed = True
+
+    for f in (index['files'] if filelist is None else filelist):
+        if f not in index['files']:
+            continue
+        entry = index['files'][f]
+        stat = os.stat(os.path.join(folderpath, f))
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+            index['files'][f] = _indexContinuous(os.path.join(folderpath, f), stat)
+            changed = True
+
+    if changed:
+        _saveIndex(folderpath, index)
+    return index
+
+def _indexContinuous(filepath, stat):
+    # header, record count and first and last timestamp of a continuous file
+    with open(filepath, 'rb') as f:
+        header = readHeader(f)
+    nrec = (stat.st_size - NUM_HEADER_BYTES) // RECORD_SIZE
+    entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'header': header, 'nrec': nrec,
+             'firstTimestamp': None, 'lastTimestamp': None}
+    if nrec > 0:
+        records = np.memmap(filepath, RECORD_DTYPE, 'r', NUM_HEADER_BYTES, (nrec,))
+        entry['firstTimestamp'] = int(records['timestamp'][0])
+        entry['lastTimestamp'] = int(records['timestamp'][-1])
+        del records
+    return entry
+
+def _saveIndex(folderpath, index):
+    # the index is only a cache, read-only recording folders are skipped silently.
+    # writing a new file changes the folder mtime, which is stored afterwards
+    indexpath = os.path.join(folderpath, INDEX_FILENAME)
+    try:
+        for i in range(2):
+            with open(indexpath, 'w') as f:
+                json.dump(index, f)
+            mtime = os.stat(folderpath).st_mtime_ns
+            if index['mtime'] == mtime:
+                break
+            index['mtime'] = mtime
+    except OSError:
+        pass
+
+def _openChannels(folderpath, filelist, dtype = float, bad = 'raise'):
+    # open continuous files as ContinuousFile, using the recording index for the headers
+    files = loadIndex(folderpath, filelist)['files']
+    return [ContinuousFile(os.path.join(folderpath, f), dtype, files.get(f), bad) for f in filelist]
+
+def digitalReference(data, dref, channels = None):
+    '''Digital referencing of a [n_samples, n_channels] chunk, done in place.
+
+    dref:     'ave' subtracts the common average, 'med' the common median of all channels,
+              a channel number subtracts that channel (channels has to list the channel
+              numbers of the columns of data).
+
+    Integer data is rounded to the nearest integer and saturates at the limits of its
+    dtype instead of wrapping around.
+    '''
+
+    if dref == 'ave':
+        reference = np.mean(data, 1)
+    elif dref == 'med':
+        reference = np.median(data, 1)
+    else:
+        reference = data[:, list(channels).index(dref)].copy()
+
+    if not np.issubdtype(data.dtype, np.integer):
+        data -= reference[:, None]
+        return data
+
+    limits = np.iinfo(data.dtype)
+    column = np.empty(len(data), np.result_type(reference.dtype, np.int32))
+    for i in range(data.shape[1]):
+        np.subtract(data[:, i], reference, out = column, dtype = column.dtype)
+        if column.dtype.kind == 'f':
+            np.rint(column, out = column)
+        np.clip(column, limits.min, limits.max, out = column)
+        data[:, i] = column
+    return data
+
+def extractSnippets(recording, timestamps, window = (-1., 2.), channels = 'all', baseline = None,
+                    dtype = np.float32, workers = 1, recordingIndex = None):
+    '''Cut windows around events out of a lazily loaded recording into a single
+    [n_events, n_channels, n_samples] array.
+
+    recording:  ContinuousFolder, or a ContinuousStream of openephys_binary.
+    timestamps: Event times in Open Ephys timestamp units (samples), e.g. the
+                'samplerate_absolut' column of sync_postprocessing.load_oo_events.
+    window:     Start and end of the window in seconds relative to the events.
+    channels:   Channel numbers (ContinuousFolder) or indices (ContinuousStream), or 'all'.
+    baseline:   Optional (start, end) in seconds relative to the events, the mean over this
+                part of the window is subtracted per event and channel.
+    dtype:      np.float32 or float for uV, np.int16 for raw samples (no baseline).
+    workers:    Number of threads, channels are gathered in parallel groups.
+    recordingIndex: Index of the recording (ContinuousFolder files with several recording
+                numbers) the windows are cut from, required if a window falls into more
+                than one recording, as in ContinuousFolder.read_range.
+
+    Samples are gathered with vectorized indexing into the memory mapped files, in batches of
+    events. Windows that cross a gap in the timestamps or the end of the recording are read
+    exactly, missing samples are NaN (0 for int16).
+    '''
+
+    rate = recording.sampleRate
+    pre = int(round(window[0] * rate))
+    n_samples = int(round((window[1] - window[0]) * rate))
+    starts = np.asarray(timestamps, np.int64).ravel() + pre
+    scale = dtype != np.int16
+
+    if isinstance(recording, ContinuousFolder):
+        if channels == 'all':
+            channels = recording.channels
+        indices = [recording.channels.index(ch) for ch in channels]
+        files = recording.files
+        if recording.dref is not None:
+            files = recording._referenceFiles
+            indices = list(range(len(files)))
+    else:
+        indices = list(range(recording.numChannels)) if channels == 'all' else list(channels)
+
+    out = np.empty((len(starts), len(indices), n_samples), dtype)
+    groups = [g for g in np.array_split(np.arange(len(indices)), workers) if len(g)]
+    batch = max(1, 2**22 // max(n_samples, 1))
+
+    if isinstance(recording, ContinuousFolder):
+        first = recording.files[0]
+        contiguous, sampleIndex = _contiguousWindows(first, starts, n_samples)
+
+        def gatherGroup(g):
+            for b in range(0, len(starts), batch):
+                events = np.flatnonzero(contiguous[b:b + batch]) + b
+                positions = sampleIndex[events][:, None] + np.arange(n_samples)
+                for i in g:
+                    out[events, i] = files[indices[i]].gather(positions, float if scale else np.int16)
+            for e in np.flatnonzero(~contiguous):
+                positions, lo, hi = first._rangePositions(starts[e], starts[e] + n_samples, 'fill', recordingIndex)
+                for i in g:
+                    files[indices[i]]._scatter(positions, lo, hi, out[e, i], float if scale else np.int16, None)
+
+        _map(gatherGroup, groups, workers)
+
+        if recording.dref is not None:
+            for e in range(len(starts)):
+                out[e] = digitalReference(out[e].T, recording.dref, recording._referenceChannels).T
+            out = out[:, [recording.channels.index(ch) for ch in channels]]
+    else:
+        streamTimestamps = recording.timestamps
+        bitVolts = recording.bitVolts[indices][None, :, None]
+        # all selected channels of a batch are gathered at once, keep the int16 block bounded
+        batch = max(1, 2**22 // max(n_samples * len(indices), 1))
+
+        def gatherBatch(b):
+            wanted = starts[b:b + batch, None] + np.arange(n_samples)
+            positions = np.searchsorted(streamTimestamps, wanted).clip(0, len(streamTimestamps) - 1)
+            valid = streamTimestamps[positions] == wanted
+            # only the selected channels are read, scaled straight into out
+            block = recording.data[positions[:, :, None], indices].transpose(0, 2, 1)
+            target = out[b:b + batch]
+            if scale:
+                np.multiply(block, bitVolts, out = target)
+            else:
+                target[...] = block
+            np.copyto(target, np.nan if scale else 0, where = ~valid[:, None, :])
+
+        _map(gatherBatch, range(0, len(starts), batch), workers)
+
+    if baseline is not None:
+        assert scale, 'Baseline subtraction needs a float dtype'
+        b0 = int(round((baseline[0] - window[0]) * rate))
+        b1 = int(round((baseline[1] - window[0]) * rate))
+        out -= np.nanmean(out[:, :, b0:b1], axis = 2, keepdims = True)
+
+    return out
+
+def _contiguousWindows(channel, starts, n_samples):
+    # sample index of every window start and whether the window lies in gap free records.
+    # only the records at the window edges are read
+    if len(channel.recordingBoundaries) > 1 or channel.nrec == 0:
+        return np.zeros(len(starts), bool), np.zeros(len(starts), np.int64)
+    timestamps = channel.records['timestamp']
+    record = channel.searchTimestamps(starts, 'right') - 1
+    offset = starts - timestamps[record.clip(0)]
+    sampleIndex = record * SAMPLES_PER_RECORD + offset
+    lastRecord = (sampleIndex + n_samples - 1) // SAMPLES_PER_RECORD
+    contiguous = (record >= 0) & (offset < SAMPLES_PER_RECORD) & (lastRecord < channel.nrec)
+    lastRecord = lastRecord.clip(0, channel.nrec - 1)
+    contiguous &= timestamps[lastRecord] - timestamps[record.clip(0)] == (lastRecord - record) * SAMPLES_PER_RECORD
+    return contiguous, sampleIndex
 
 def loadSpikes(filepath):
 
     '''
     Loads spike waveforms and timestamps from filepath (should be .spikes file)
 
+    The record size is derived from the first spike, all spikes are then read in one call
+    as a structured array. Waveforms are returned as float32 in uV.
+
     '''
 
     data = { }
@@ -186,57 +919,43 @@ def loadSpikes(filepath):
     numChannels = int(header['num_channels'])
     numSamples = 40 # **NOT CURRENTLY WRITTEN TO HEADER**
 
-    spikes = np.zeros((MAX_NUMBER_OF_SPIKES, numSamples, numChannels))
-    timestamps = np.zeros(MAX_NUMBER_OF_SPIKES)
-    source = np.zeros(MAX_NUMBER_OF_SPIKES)
-    gain = np.zeros((MAX_NUMBER_OF_SPIKES, numChannels))
-    thresh = np.zeros((MAX_NUMBER_OF_SPIKES, numChannels))
-    sortedId = np.zeros((MAX_NUMBER_OF_SPIKES, numChannels))
-    recNum = np.zeros(MAX_NUMBER_OF_SPIKES)
-
-    currentSpike = 0
-
-    while f.tell() < os.fstat(f.fileno()).st_size:
-        eventType = np.fromfile(f, np.dtype('<u1'),1) #always equal to 4, discard
-        timestamps[currentSpike] = np.fromfile(f, np.dtype('<i8'), 1)
-        software_timestamp = np.fromfile(f, np.dtype('<i8'), 1)
-        source[currentSpike] = np.fromfile(f, np.dtype('<u2'), 1)
-        numChannels = np.fromfile(f, np.dtype('<u2'), 1)[0]
-        numSamples = np.fromfile(f, np.dtype('<u2'), 1)[0]
-        sortedId[currentSpike] = np.fromfile(f, np.dtype('<u2'),1)
-        electrodeId = np.fromfile(f, np.dtype('<u2'),1)
-        channel = np.fromfile(f, np.dtype('<u2'),1)
-        color = np.fromfile(f, np.dtype('<u1'), 3)
-        pcProj = np.fromfile(f, np.float32, 2)
-        sampleFreq = np.fromfile(f, np.dtype('<u2'),1)
-
-        waveforms = np.fromfile(f, np.dtype('<u2'), numChannels*numSamples)
-        gain[currentSpike,:] = np.fromfile(f, np.float32, numChannels)
-        thresh[currentSpike,:] = np.fromfile(f, np.dtype('<u2'), numChannels)
-        recNum[currentSpike] = np.fromfile(f, np.dtype('<u2'), 1)
-
-        waveforms_reshaped = np.reshape(waveforms, (numChannels, numSamples))
-        waveforms_reshaped = waveforms_reshaped.astype(float)
-        waveforms_uv = waveforms_reshaped
-
-        for ch in range(numChannels):
-            waveforms_uv[ch, :] -= 32768
-            waveforms_uv[ch, :] /= gain[currentSpike, ch]*1000
-
-        spikes[currentSpike] = waveforms_uv.T
-
-        currentSpike += 1
-
-    data['spikes'] = spikes[:currentSpike,:,:]
-    data['timestamps'] = timestamps[:currentSpike]
-    data['source'] = source[:currentSpike]
-    data['gain'] = gain[:currentSpike,:]
-    data['thresh'] = thresh[:currentSpike,:]
-    data['recordingNumber'] = recNum[:currentSpike]
-    data['sortedId'] = sortedId[:currentSpike]
+    # numChannels and numSamples of the first spike define the size of every record
+    first = np.fromfile(f, SPIKE_HEADER_DTYPE, 1)
+    if len(first):
+        numChannels = int(first['numChannels'][0])
+        numSamples = int(first['numSamples'][0])
+
+    recordDtype = spikeRecordDtype(numChannels, numSamples)
+    f.seek(NUM_HEADER_BYTES)
+    nspikes = (os.fstat(f.fileno()).st_size - NUM_HEADER_BYTES) // recordDtype.itemsize
+    records = np.fromfile(f, recordDtype, nspikes)
+    f.close()
+
+    gain = records['gain'].astype(np.float32)
+
+    # convert to uV, waveforms are stored per channel as [numChannels, numSamples]
+    spikes = records['waveforms'].astype(np.float32)
+    spikes -= 32768
+    spikes /= gain[:, :, None] * 1000
+
+    data['spikes'] = spikes.transpose(0, 2, 1)
+    data['timestamps'] = records['timestamp'].astype(float)
+    data['source'] = records['source'].astype(float)
+    data['gain'] = gain.astype(float)
+    data['thresh'] = records['thresh'].astype(float)
+    data['recordingNumber'] = records['recordingNumber'].astype(float)
+    data['sortedId'] = records['sortedId'].astype(float)
 
     return data
 
+def spikeRecordDtype(numChannels, numSamples = 40):
+    '''Layout of a single record of a .spikes file with numChannels channels.'''
+    return np.dtype(SPIKE_HEADER_DTYPE.descr +
+                    [('waveforms', '<u2', (numChannels, numSamples)),
+                     ('gain', '<f4', numChannels),
+                     ('thresh', '<u2', numChannels),
+                     ('recordingNumber', '<u2')])
+
 
 def loadEvents(filepath):
 
@@ -252,35 +971,17 @@ def loadEvents(filepath):
 
     data['header'] = header
 
-    index = -1
-
-    channel = np.zeros(MAX_NUMBER_OF_EVENTS)
-    timestamps = np.zeros(MAX_NUMBER_OF_EVENTS)
-    sampleNum = np.zeros(MAX_NUMBER_OF_EVENTS)
-    nodeId = np.zeros(MAX_NUMBER_OF_EVENTS)
-    eventType = np.zeros(MAX_NUMBER_OF_EVENTS)
-    eventId = np.zeros(MAX_NUMBER_OF_EVENTS)
-    recordingNumber = np.zeros(MAX_NUMBER_OF_EVENTS)
-
-    while f.tell() < os.fstat(f.fileno()).st_size:
-
-        index += 1
-
-        timestamps[index] = np.fromfile(f, np.dtype('<i8'), 1)
-        sampleNum[index] = np.fromfile(f, np.dtype('<i2'), 1)
-        eventType[index] = np.fromfile(f, np.dtype('<u1'), 1)
-        nodeId[index] = np.fromfile(f, np.dtype('<u1'), 1)
-        eventId[index] = np.fromfile(f, np.dtype('<u1'), 1)
-        channel[index] = np.fromfile(f, np.dtype('<u1'), 1)
-        recordingNumber[index] = np.fromfile(f, np.dtype('<u2'), 1)
+    nevents = (os.fstat(f.fileno()).st_size - NUM_HEADER_BYTES) // EVENT_DTYPE.itemsize
+    events = np.fromfile(f, EVENT_DTYPE, nevents)
+    f.close()
 
-    data['channel'] = channel[:index]
-    data['timestamps'] = timestamps[:index]
-    data['eventType'] = eventType[:index]
-    data['nodeId'] = nodeId[:index]
-    data['eventId'] = eventId[:index]
-    data['recordingNumber'] = recordingNumber[:index]
-    data['sampleNum'] = sampleNum[:index]
+    data['channel'] = events['channel'].astype(float)
+    data['timestamps'] = events['timestamp'].astype(float)
+    data['eventType'] = events['eventType'].astype(float)
+    data['nodeId'] = events['nodeId'].astype(float)
+    data['eventId'] = events['eventId'].astype(float)
+    data['recordingNumber'] = events['recordingNumber'].astype(float)
+    data['sampleNum'] = events['sampleNum'].astype(float)
 
     return data
 
@@ -293,124 +994,416 @@ def readHeader(f):
     return header
 
 def downsample(trace,down):
-    downsampled = scipy.signal.resample(trace,np.shape(trace)[0]/down)
+    # anti-aliased decimation by the integer factor down, see Decimator
+    decimator = Decimator(int(down))
+    downsampled = np.concatenate((decimator.process(trace), decimator.flush()))
     return downsampled
 
+class Decimator:
+    '''Streaming anti-aliased decimation by an integer factor along the first axis.
+
+    A linear phase low-pass FIR filter is evaluated only at the output samples (polyphase,
+    via scipy.signal.upfirdn). The last input samples are kept between calls, so feeding a
+    signal in chunks gives the same result as feeding it at once. Output sample i is centered
+    on input sample i * down, call flush() after the last chunk to get the final samples.
+
+    down:    Integer decimation factor.
+    numtaps: Length of the FIR filter, by default 20 * down + 1.
+    '''
+
+    def __init__(self, down, numtaps = None):
+        if numtaps is None:
+            numtaps = 20 * down + 1
+        numtaps += 1 - numtaps % 2  # odd length for an integer group delay
+        assert numtaps > down, 'numtaps has to be larger than the decimation factor'
+
+        self.down = down
+        self.taps = scipy.signal.firwin(numtaps, 1. / down, window = ('kaiser', 5.0))
+        self.delay = (numtaps - 1) // 2
+        self.tail = None
+
+    def process(self, chunk):
+        '''Filter and decimate the next chunk, returns all output samples that are complete.'''
+        chunk = np.asarray(chunk)
+        if self.tail is None:
+            self.tail = np.zeros((self.delay,) + chunk.shape[1:])
+
+        history = len(self.taps) - 1
+        pad = -history % self.down
+        x = np.concatenate((np.zeros((pad,) + chunk.shape[1:]), self.tail, chunk))
+
+        first = history + pad  # index in x of the next output sample, a multiple of down
+        if len(x) <= first:
+            self.tail = x[pad:]
+            return np.zeros((0,) + chunk.shape[1:])
+        n = (len(x) - 1 - first) // self.down + 1
+
+        k = first // self.down
+        y = scipy.signal.upfirdn(self.taps, x[:first + (n - 1) * self.down + 1], 1, self.down, axis = 0)[k:k + n]
+
+        self.tail = x[first + n * self.down - history:]
+        return y
+
+    def flush(self):
+        '''Return the output samples that are still held back by the filter delay.'''
+        if self.tail is None:
+            return np.zeros(0)
+        return self.process(np.zeros((self.delay,) + self.tail.shape[1:]))
+
+def extractLFP(folderpath, rate = 1000, filename = '', channels = 'all', chprefix = 'CH',
+               session = '0', source = '100', dref = None, chunk_records = 256, workers = 1):
+    '''Downsample all continuous channels of a folder to an LFP array, stored as a float32
+    .npy file (in uV) next to the recording. Data is read in chunks of chunk_records records
+    from the memory mapped channels and decimated with a streaming Decimator, so memory use
+    does not depend on the length of the recording.
+
+    rate:     Target sample rate in Hz, the sample rate of the recording has to be an integer
+              multiple of it (e.g. 1000, 1500 or 2500 for 30 kHz recordings).
+    filename: Name of the output file, by default e.g. '100_CHs_lfp1000.npy'.
+    dref:     Optional digital reference applied before filtering, see digitalReference.
+    workers:  Number of threads used to decode and filter the channels in parallel.
+
+    Returns the output array, memory mapped from the .npy file.
+    '''
+
+    recording = ContinuousFolder(folderpath, channels, chprefix, float, session, source, dref)
+
+    sampleRate = recording.files[0].sampleRate
+    down = int(round(sampleRate / rate))
+    if down < 1 or down * rate != sampleRate:
+        raise Exception('Sample rate ' + str(sampleRate) + ' is not an integer multiple of ' + str(rate))
+
+    if session == '0': session = ''
+    else: session = '_'+session
+
+    if not filename: filename = source + '_' + chprefix + 's' + session + '_lfp' + str(rate) + '.npy'
+    print('Extracting LFP to file: ' + filename)
+
+    t0 = time.time()
+    n_samples, n_channels = recording.shape
+    lfp = np.lib.format.open_memmap(os.path.join(folderpath, filename), 'w+', np.float32,
+                                    (-(-n_samples // down), n_channels))
+
+    # every group of channels is decimated on its own thread
+    groups = [g for g in np.array_split(np.arange(n_channels), workers) if len(g)]
+    decimators = [Decimator(down) for g in groups]
+    position = 0
+
+    def decimate(i, data):
+        return decimators[i].process(data[:, groups[i]])
+
+    chunkSize = chunk_records * SAMPLES_PER_RECORD
+    for start in range(0, n_samples + chunkSize, chunkSize):
+        if start < n_samples:
+            data = recording.read(start, start + chunkSize, workers = workers)
+            results = _map(lambda i: decimate(i, data), range(len(groups)), workers)
+        else:
+            results = [d.flush() for d in decimators]
+        n = len(results[0])
+        for g, y in zip(groups, results):
+            lfp[position:position + n, g] = y
+        position += n
+
+    lfp.flush()
+    print(''.join(('Total LFP Extraction Time: ', str((time.time() - t0)),' sec')))
+
+    return lfp
+
+def bandpass(low, high, rate, order = 3):
+    '''Butterworth band-pass filter as second order sections, e.g. bandpass(300, 6000, 30000)
+    for spike data. Pass the result to ChunkFilter.'''
+    return scipy.signal.butter(order, [low, high], 'bandpass', fs = rate, output = 'sos')
+
+class ChunkFilter:
+    '''Stateful filter for [n_samples, n_channels] chunks of a continuous signal.
+
+    sos:       Second order sections of an IIR filter, e.g. from bandpass().
+    taps:      Coefficients of a FIR filter, used if no sos are given.
+    zerophase: Filter forward and backward. Every chunk is filtered with overlap samples of
+               neighbouring data on each side, so output lags input by overlap samples;
+               call flush() after the last chunk to get the remaining output.
+    overlap:   Margin in samples for zero-phase filtering, should cover the decay of the
+               filter's impulse response.
+    workers:   Number of threads, channels are split in groups that are filtered in parallel.
+
+    In causal mode the filter state (zi) is carried between chunks, so chunked and one-shot
+    filtering give the same result.
+    '''
+
+    def __init__(self, sos = None, taps = None, zerophase = False, overlap = 8192, workers = 1):
+        assert (sos is None) != (taps is None), 'Specify either sos or taps'
+        self.sos = None if sos is None else np.asarray(sos)
+        self.taps = None if taps is None else np.asarray(taps)
+        self.zerophase = zerophase
+        self.overlap = overlap
+        self.workers = workers
+        self.groups = None
+
+    def process(self, chunk):
+        '''Filter the next chunk and return all output samples that are final.'''
+        chunk = np.asarray(chunk)
+        if self.groups is None:
+            self.groups = [{'channels': g, 'zi': None, 'buffer': None, 'start': 0}
+                           for g in np.array_split(np.arange(chunk.shape[1]), self.workers) if len(g)]
+        results = _map(lambda g: self._process(g, chunk[:, g['channels']]), self.groups, self.workers)
+        return np.hstack(results)
+
+    def flush(self):
+        '''Return the output held back by zero-phase filtering.'''
+        if self.groups is None:
+            return np.zeros((0, 0))
+        results = _map(lambda g: self._process(g, None), self.groups, self.workers)
+        return np.hstack(results)
+
+    def _process(self, group, x):
+        if not self.zerophase:
+            if x is None:
+                return np.zeros((0, len(group['channels'])))
+            return self._causal(group, x)
+
+        # zero-phase: keep 2 * overlap samples of history, only the middle part is final
+        if x is not None:
+            group['buffer'] = x if group['buffer'] is None else np.concatenate((group['buffer'], x))
+        buffer = group['buffer']
+        if buffer is None:
+            return np.zeros((0, len(group['channels'])))
+        if x is None:
+            group['buffer'] = None
+            return self._filtfilt(buffer)[group['start']:]
+        if len(buffer) <= 2 * self.overlap:
+            return np.zeros((0, len(group['channels'])))
+        y = self._filtfilt(buffer)[group['start']:len(buffer) - self.overlap]
+        group['buffer'] = buffer[len(buffer) - 2 * self.overlap:]
+        group['start'] = self.overlap
+        return y
+
+    def _causal(self, group, x):
+        if self.sos is not None:
+            if group['zi'] is None:
+                group['zi'] = scipy.signal.sosfilt_zi(self.sos)[:, :, None] * x[0]
+            y, group['zi'] = scipy.signal.sosfilt(self.sos, x, axis = 0, zi = group['zi'])
+        else:
+            if group['zi'] is None:
+                group['zi'] = scipy.signal.lfilter_zi(self.taps, 1.)[:, None] * x[0]
+            y, group['zi'] = scipy.signal.lfilter(self.taps, 1., x, axis = 0, zi = group['zi'])
+        return y
+
+    def _filtfilt(self, x):
+        if self.sos is not None:
+            padlen = min(3 * (2 * len(self.sos) + 1), len(x) - 1)
+            return scipy.signal.sosfiltfilt(self.sos, x, axis = 0, padlen = padlen)
+        padlen = min(3 * len(self.taps), len(x) - 1)
+        return scipy.signal.filtfilt(self.taps, 1., x, axis = 0, padlen = padlen)
+
+def filterFolder(folderpath, filt, filename = '', dtype = np.int16, channels = 'all', chprefix = 'CH',
+                 session = '0', source = '100', dref = None, chunk_records = 256, workers = 1):
+    '''Filter all continuous channels of a folder in a single streaming pass and write the
+    result as an interleaved [n_samples, n_channels] binary file next to the recording.
+
+    filt:     ChunkFilter applied to every chunk, e.g. ChunkFilter(bandpass(300, 6000, 30000)).
+    filename: Name of the output file, by default e.g. '100_CHs_filtered.dat'.
+    dtype:    np.int16 keeps raw ADC units (same layout as pack_2), np.float32 writes uV.
+    dref:     Optional digital reference applied before filtering, see digitalReference.
+    workers:  Number of threads used to decode the channels in parallel.
+
+    Returns the output file as a np.memmap.
+    '''
+
+    recording = ContinuousFolder(folderpath, channels, chprefix,
+                                 np.int16 if dtype == np.int16 else float, session, source, dref)
+
+    if session == '0': session = ''
+    else: session = '_'+session
+
+    if not filename: filename = source + '_' + chprefix + 's' + session + '_filtered.dat'
+    print('Filtering data to file: ' + filename)
+
+    t0 = time.time()
+    out = np.memmap(os.path.join(folderpath, filename), dtype, 'w+', shape = recording.shape)
+    position = 0
+    for data in _iterChunks(recording, chunk_records, workers, filt):
+        out[position:position + len(data)] = data
+        position += len(data)
+    out.flush()
+
+    print(''.join(('Total Filter Time: ', str((time.time() - t0)),' sec')))
+
+    return out
+
+def detectSpikes(recording, threshold = 5., band = (300, 6000), dead_time = 1., waveform = (10, 30),
+                 chunk_records = 64, overlap = 2048, noise_chunks = 10, workers = 1):
+    '''Detect negative threshold crossings on all channels of a ContinuousFolder in chunks.
+
+    threshold:     Detection threshold in multiples of the noise, which is estimated per
+                   channel as median(|x|) / 0.6745 (MAD) on noise_chunks 1 s windows spread
+                   over the recording.
+    band:          Pass band in Hz of the zero-phase Butterworth filter applied before detection.
+    dead_time:     Refractory period in ms, later crossings on the same channel are dropped.
+    waveform:      Number of samples (before, after) the peak kept as waveform, None for none.
+    chunk_records: Number of records (1024 samples) per chunk.
+    overlap:       Samples read and filtered on both sides of every chunk, so spikes at chunk
+                   edges are detected and cut like any other.
+    workers:       Number of threads used to decode and filter channel groups in parallel.
+
+    Returns a structured array sorted by time with the fields 'sample', 'timestamp',
+    'channel' (channel number), 'amplitude' (uV, filtered) and, if requested, 'waveform'.
+    '''
+
+    rate = recording.sampleRate
+    n_samples, n_channels = recording.shape
+    sos = bandpass(band[0], band[1], rate)
+    groups = [g for g in np.array_split(np.arange(n_channels), workers) if len(g)]
+    dead = max(int(round(dead_time * rate / 1000.)), 1)
+
+    fields = [('sample', '<i8'), ('timestamp', '<i8'), ('channel', '<u2'), ('amplitude', '<f4')]
+    if waveform is not None:
+        pre, post = waveform
+        fields.append(('waveform', '<f4', (pre + post,)))
+    spikeDtype = np.dtype(fields)
+
+    def filtered(start, stop):
+        # filtered float32 data of [start - overlap, stop + overlap) and the index it starts at
+        lo = max(start - overlap, 0)
+        data = recording.read(lo, min(stop + overlap, n_samples), dtype = float, workers = workers)
+        padlen = min(3 * (2 * len(sos) + 1), len(data) - 1)
+        filt = lambda g: scipy.signal.sosfiltfilt(sos, data[:, g], axis = 0, padlen = padlen).astype(np.float32)
+        return np.hstack(_map(filt, groups, workers)), lo
+
+    t0 = time.time()
+
+    # noise level per channel
+    length = min(int(rate), n_samples)
+    medians = []
+    for start in np.unique(np.linspace(0, n_samples - length, noise_chunks).astype(np.int64)):
+        y, lo = filtered(start, start + length)
+        medians.append(np.median(np.abs(y[start - lo:start - lo + length]), 0))
+    thresholds = threshold * np.median(medians, 0) / 0.6745
+
+    lastSpike = np.full(n_channels, -2 * dead, np.int64)
+    chunkSize = chunk_records * SAMPLES_PER_RECORD
+    spikes = []
+
+    for start in range(0, n_samples, chunkSize):
+        stop = min(start + chunkSize, n_samples)
+        y, lo = filtered(start, stop)
+
+        # crossings of all channels at once, only those in the core of the chunk count
+        below = y < -thresholds
+        t, ch = np.nonzero(below[1:] & ~below[:-1])
+        t += 1
+        core = (t + lo >= start) & (t + lo < stop)
+        t, ch = t[core], ch[core]
+
+        # peak within the dead time after the crossing
+        window = (t[:, None] + np.arange(dead)).clip(max = len(y) - 1)
+        peak = t + np.argmin(y[window, ch[:, None]], 1)
+        sample = peak + lo
+
+        # refractory period, compared to the last kept spike on the same channel. dropped
+        # crossings don't extend it, so this is a sequential pass over the (few) crossings
+        order = np.lexsort((sample, ch))
+        ch, peak, sample = ch[order], peak[order], sample[order]
+        keep = np.zeros(len(sample), bool)
+        last = lastSpike.tolist()
+        for i, (c, s) in enumerate(zip(ch.tolist(), sample.tolist())):
+            if s - last[c] >= dead:
+                keep[i] = True
+                last[c] = s
+        lastSpike[:] = last
+        ch, peak, sample = ch[keep], peak[keep], sample[keep]
+
+        chunkSpikes = np.zeros(len(sample), spikeDtype)
+        chunkSpikes['sample'] = sample
+        chunkSpikes['channel'] = np.asarray(recording.channels)[ch]
+        chunkSpikes['amplitude'] = y[peak, ch]
+        if waveform is not None:
+            window = (peak[:, None] + np.arange(-pre, post)).clip(0, len(y) - 1)
+            chunkSpikes['waveform'] = y[window, ch[:, None]]
+        spikes.append(chunkSpikes)
+
+    spikes = np.concatenate(spikes) if spikes else np.zeros(0, spikeDtype)
+    spikes = spikes[np.lexsort((spikes['channel'], spikes['sample']))]
+
+    timestamps = recording.timestamps
+    spikes['timestamp'] = timestamps[spikes['sample'] // SAMPLES_PER_RECORD] + spikes['sample'] % SAMPLES_PER_RECORD
+
+    print(''.join(('Detected ', str(len(spikes)), ' spikes in ', str((time.time() - t0)), ' sec')))
+
+    return spikes
+
 def pack(folderpath,source='100',**kwargs):
 #convert single channel open ephys channels to a .dat file for compatibility with the KlustaSuite, Neuroscope and Klusters
 #should not be necessary for versions of open ephys which write data into HDF5 format.
 #loads .continuous files in the specified folder and saves a .DAT in that folder
+#thin wrapper around pack_2, which streams the data to disk in chunks
 #optional arguments:
 #   source: string name of the source that openephys uses as the prefix. is usually 100, if the headstage is the first source added, but can specify something different
 #
 #   data: pre-loaded data to be packed into a .DAT
-#   dref: int specifying a channel # to use as a digital reference. is subtracted from all channels.
+#   dref: int specifying a channel # to use as a digital reference. is subtracted from all channels. 'ave' or 'med' subtract the average or median of all channels.
 #   order: the order in which the .continuos files are packed into the .DAT. should be a list of .continious channel numbers. length must equal total channels.
 #   suffix: appended to .DAT filename, which is openephys.DAT if no suffix provided.
+#   chunk_records: number of records per channel that are held in memory at once
+
+    #add a suffix, if one was specified
+    suffix = kwargs.get('suffix', '')
+    outpath = os.path.join(folderpath,''.join(('openephys',suffix,'.dat')))
 
-    #load the openephys data into memory
-    if 'data' not in kwargs.keys():
-        if 'channels' not in kwargs.keys():
-            data = loadFolder(folderpath, dtype = np.int16)
-        else:
-            data = loadFolder(folderpath, dtype = np.int16, channels=kwargs['channels'])
-    else:
-        data = kwargs['data']
-    #if specified, do the digital referencing
-    if 'dref' in kwargs.keys():
-        ref =load(os.path.join(folderpath,''.join((source,'_CH',str(kwargs['dref']),'.continuous'))))
-        for i,channel in enumerate(data.keys()):
-            data[channel]['data'] = data[channel]['data'] - ref['data']
     #specify the order the channels are written in
     if 'order' in kwargs.keys():
         order = kwargs['order']
+    elif 'channels' in kwargs.keys():
+        order = kwargs['channels']
+    elif 'data' in kwargs.keys():
+        order = list(kwargs['data'])
     else:
-        order = list(data)
-    #add a suffix, if one was specified
-    if 'suffix' in kwargs.keys():
-        suffix=kwargs['suffix']
-    else:
-        suffix=''
+        order = 'all'
 
-    #make a file to write the data back out into .dat format
-    outpath = os.path.join(folderpath,''.join(('openephys',suffix,'.dat')))
-    out = open(outpath,'wb')
-
-    #go through the data and write it out in the .dat format
-    #.dat format specified here: http://neuroscope.sourceforge.net/UserManual/data-files.html
-    channelOrder = []
-    print(''.join(('...saving .dat to ',outpath,'...')))
-    random_datakey = next(iter(data))
-    bar = ProgressBar(len(data[random_datakey]['data']))
-    for i in range(len(data[random_datakey]['data'])):
-        for j in range(len(order)):
-            if source in random_datakey:
-                ch = data[order[j]]['data']
+    #pre-loaded data is already in memory, write it out in one go
+    if 'data' in kwargs.keys():
+        data = kwargs['data']
+        random_datakey = next(iter(data))
+        if source in random_datakey:
+            columns = [data[ch]['data'] for ch in order]
+        else:
+            columns = [data[''.join(('CH',str(ch).replace('CH','')))]['data'] for ch in order]
+        data = np.column_stack(columns).astype(np.int16)
+        channelOrder = order
+        if kwargs.get('dref') is not None:
+            dref = kwargs['dref']
+            channels = [int(str(ch).split('CH')[-1]) for ch in order]
+            if dref not in ('ave', 'med'):
+                dref = int(str(dref).split('CH')[-1])
+            if dref in ('ave', 'med') or dref in channels:
+                digitalReference(data, dref, channels)
             else:
-                ch = data[''.join(('CH',str(order[j]).replace('CH','')))]['data']
-            out.write(struct.pack('h',ch[i]))#signed 16-bit integer
-            #figure out which order this thing packed the channels in. only do this once.
-            if i == 0:
-                channelOrder.append(order[j])
-        #update how mucb we have list
-        if i%(len(data[random_datakey]['data'])/100)==0:
-            bar.animate(i)
-    out.close()
+                #the reference channel is not part of the data, read it from its file
+                ref = ContinuousFile(os.path.join(folderpath,''.join((source,'_CH',str(dref),'.continuous'))), np.int16)
+                data = digitalReference(np.column_stack((data, ref[:len(data)])), dref, channels + [dref])[:, :-1]
+        print(''.join(('...saving .dat to ',outpath,'...')))
+        data.tofile(outpath)
+    else:
+        if order != 'all':
+            order = [int(str(ch).split('CH')[-1]) for ch in order]
+        channelOrder = pack_2(folderpath, os.path.basename(outpath), order, dref = kwargs.get('dref'),
+                              source = source, chunk_records = kwargs.get('chunk_records', 256))
+
     print(''.join(('order: ',str(channelOrder))))
     print(''.join(('.dat saved to ',outpath)))
 
-#**********************************************************
-# progress bar class used to show progress of pack()
-    #stolen from some post on stack overflow
-import sys
-try:
-    from IPython.display import clear_output
-    have_ipython = True
-except ImportError:
-    have_ipython = False
-class ProgressBar:
-    def __init__(self, iterations):
-        self.iterations = iterations
-        self.prog_bar = '[]'
-        self.fill_char = '*'
-        self.width = 40
-        self.__update_amount(0)
-        if have_ipython:
-            self.animate = self.animate_ipython
-        else:
-            self.animate = self.animate_noipython
-
-    def animate_ipython(self, iter):
-        print('\r', self,)
-        sys.stdout.flush()
-        self.update_iteration(iter + 1)
-
-    def update_iteration(self, elapsed_iter):
-        self.__update_amount((elapsed_iter / float(self.iterations)) * 100.0)
-        self.prog_bar += '  %d of %s complete' % (elapsed_iter, self.iterations)
-
-    def __update_amount(self, new_amount):
-        percent_done = int(round((new_amount / 100.0) * 100.0))
-        all_full = self.width - 2
-        num_hashes = int(round((percent_done / 100.0) * all_full))
-        self.prog_bar = '[' + self.fill_char * num_hashes + ' ' * (all_full - num_hashes) + ']'
-        pct_place = (len(self.prog_bar) // 2) - len(str(percent_done))
-        pct_string = '%d%%' % percent_done
-        self.prog_bar = self.prog_bar[0:pct_place] + \
-            (pct_string + self.prog_bar[pct_place + len(pct_string):])
-
-    def __str__(self):
-        return str(self.prog_bar)
-#*************************************************************
-
 def pack_2(folderpath, filename = '', channels = 'all', chprefix = 'CH',
-           dref = None, session = '0', source = '100'):
+           dref = None, session = '0', source = '100', workers = 1, chunk_records = 256,
+           filt = None):
 
     '''Alternative version of pack which uses numpy's tofile function to write data.
     pack_2 is much faster than pack and avoids quantization noise incurred in pack due
     to conversion of data to float voltages during loadContinous followed by rounding
     back to integers for packing.
 
+    Data is streamed: chunk_records records of every channel are read, interleaved and
+    appended to the output file at a time, so memory use does not depend on the length
+    of the recording.
+
     filename: Name of the output file. By default, it follows the same layout of continuous files,
               but without the channel number, for example, '100_CHs_3.dat' or '100_ADCs.dat'.
 
@@ -420,40 +1413,69 @@ def pack_2(folderpath, filename = '', channels = 'all', chprefix = 'CH',
     chprefix:  String name that defines if channels from headstage, auxiliary or ADC inputs
                will be loaded.
 
-    dref:  Digital referencing - either supply a channel number or 'ave' to reference to the
-           average of packed channels.
+    dref:  Digital referencing - either supply a channel number, 'ave' to reference to the
+           average or 'med' to reference to the median of packed channels. Referencing is done
+           per chunk, results saturate at the int16 limits.
 
     source: String name of the source that openephys uses as the prefix. It is usually 100,
             if the headstage is the first source added, but can specify something different.
 
+    workers: Number of threads used to load the channels in parallel.
+
+    chunk_records: Number of records (1024 samples each) per channel held in memory at once.
+
+    filt: Optional ChunkFilter (e.g. ChunkFilter(bandpass(300, 6000, 30000))) applied after
+          referencing, so a single pass produces filtered data ready for spike sorting.
+
+    Returns the list of packed channel numbers in the order they were written.
+
     '''
 
-    data_array = loadFolderToArray(folderpath, channels, chprefix, np.int16, session, source)
+    recording = ContinuousFolder(folderpath, channels, chprefix, np.int16, session, source, dref)
 
     if dref:
         if dref == 'ave':
             print('Digital referencing to average of all channels.')
-            reference = np.mean(data_array,1)
+        elif dref == 'med':
+            print('Digital referencing to median of all channels.')
         else:
             print('Digital referencing to channel ' + str(dref))
-            if channels == 'all':
-                channels = _get_sorted_channels(folderpath, chprefix, session, source)
-            reference = deepcopy(data_array[:,channels.index(dref)])
-        for i in range(data_array.shape[1]):
-            data_array[:,i] = data_array[:,i] - reference
 
     if session == '0': session = ''
     else: session = '_'+session
 
     if not filename: filename = source + '_' + chprefix + 's' + session + '.dat'
     print('Packing data to file: ' + filename)
-    data_array.tofile(os.path.join(folderpath,filename))
+
+    t0 = time.time()
+
+    # corrupted records raise while reading, don't leave a partly packed file behind
+    outpath = os.path.join(folderpath,filename)
+    try:
+        with open(outpath, 'wb') as out:
+            for data in _iterChunks(recording, chunk_records, workers, filt):
+                data.tofile(out)
+    except Exception:
+        os.remove(outpath)
+        raise
+
+    print(''.join(('Total Pack Time: ', str((time.time() - t0)),' sec')))
+
+    return recording.channels
 
 
 def _get_sorted_channels(folderpath, chprefix='CH', session='0', source='100'):
-    Files = [f for f in os.listdir(folderpath) if '.continuous' in f
-                                               and '_'+chprefix in f
-                                               and source in f]
+    index = loadIndex(folderpath, [])
+    key = '_'.join((source, chprefix, session))
+    if key not in index['channels']:
+        index['channels'][key] = _sort_channels(list(index['files']), chprefix, session, source)
+        _saveIndex(folderpath, index)
+    return list(index['channels'][key])
+
+def _sort_channels(filelist, chprefix='CH', session='0', source='100'):
+    Files = [f for f in filelist if '.continuous' in f
+                                 and '_'+chprefix in f
+                                 and source in f]
 
     if session == '0':
         Files = [f for f in Files if len(f.split('_')) == 2]
@@ -464,4 +1486,42 @@ def _get_sorted_channels(folderpath, chprefix='CH', session='0', source='100'):
 
         Chs = sorted([int(f.split('_'+chprefix)[1].split('_')[0]) for f in Files])
 
-    return(Chs)
\ No newline at end of file
+    return(Chs)
+
+
+def _get_filelist(channels, chprefix='CH', session='0', source='100'):
+    if session == '0':
+        return [source + '_'+chprefix + x + '.continuous' for x in map(str,channels)]
+    return [source + '_'+chprefix + x + '_' + session + '.continuous' for x in map(str,channels)]
+
+def _map(func, iterable, workers=1):
+    # map func over iterable on a thread pool, results keep the order of iterable
+    if workers == 1:
+        return list(map(func, iterable))
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(func, iterable))
+
+def _iterChunks(recording, chunk_records=256, workers=1, filt=None):
+    # yield consecutive [n, n_channels] blocks of a ContinuousFolder in its dtype, optionally
+    # passed through a ChunkFilter. without a filter the same buffer is reused for every block
+    n_samples = len(recording)
+    chunkSize = chunk_records * SAMPLES_PER_RECORD
+    chunk = np.empty([min(chunkSize, n_samples), len(recording.channels)], recording.dtype)
+
+    for start in range(0, n_samples, chunkSize):
+        stop = min(start + chunkSize, n_samples)
+        data = recording.read(start, stop, out = chunk[:stop - start], workers = workers)
+        if filt is None:
+            yield data
+        else:
+            yield _saturate(filt.process(data), recording.dtype)
+
+    if filt is not None:
+        yield _saturate(filt.flush(), recording.dtype)
+
+def _saturate(data, dtype):
+    # round and clip to the range of integer dtypes
+    if not np.issubdtype(dtype, np.integer):
+        return data
+    limits = np.iinfo(dtype)
+    return np.clip(np.rint(data), limits.min, limits.max).astype(dtype)
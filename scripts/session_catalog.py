@@ -0,0 +1,269 @@
+# !/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+SQLite catalog of all sessions of a pybpod project, so sessions can be listed and searched
+without opening every session folder.
+
+Sessions live in <project>/experiments/<experiment>/setups/<setup>/sessions/<name>/ with
+<name>.csv and <name>_settings_obj.json (written by TrialParameterHandler.save_usersettings).
+The catalog stores the header of the csv, the trial count and the key settings of every
+session in <project>/sessions.sqlite. update() only reindexes sessions whose files changed.
+
+Usage:
+    from session_catalog import SessionCatalog
+    catalog = SessionCatalog(project_path)
+    catalog.update()
+    catalog.find(subject='test_subject', task='gamble_task_recording', started_after='2021-02-01')
+"""
+
+import ast
+import json
+import logging
+import os
+import re
+import sqlite3
+
+from session_csv import read_header
+
+logger = logging.getLogger(__name__)
+
+CATALOG_FILENAME = 'sessions.sqlite'
+CATALOG_VERSION = 2
+SETTINGS_SUFFIX = '_settings_obj.json'
+
+# settings of TrialParameterHandler that get their own column, column name: attribute name
+KEY_SETTINGS = {'task': 'task',
+                'gamble_side': 'gamble_side',
+                'big_reward': 'big_reward',
+                'small_reward': 'small_reward',
+                'trial_number': 'trial_number',
+                'animal_weight': 'animal_waight',
+                'animal_weight_after': 'animal_waight_after',
+                'stim_type': 'stim_type',
+                'insist_range_trigger': 'insist_range_trigger'}
+
+COLUMNS = ['path', 'name', 'uuid4', 'experiment', 'setup', 'subject', 'subject_uuid4', 'task',
+           'started', 'ended', 'trials', 'csv_size', 'csv_mtime', 'settings_mtime',
+           'settings'] + ['setting_' + key for key in KEY_SETTINGS]
+
+SESSION_ENDED = re.compile(rb'^INFO;[^;\n]*;[^;\n]*;[^;\n]*;SESSION-ENDED;([^\r\n]*)', re.MULTILINE)
+
+
+def session_files(session_path):
+    """csv and settings file of a session folder"""
+    name = os.path.basename(os.path.normpath(session_path))
+    return (os.path.join(session_path, name + '.csv'),
+            os.path.join(session_path, name + SETTINGS_SUFFIX))
+
+
+def scan_body(filepath, chunk_size=1 << 20, tail_size=1 << 16):
+    """
+    Count the trials of a session csv and find its end time, without parsing it.
+
+    :return: (number of TRIAL rows, SESSION-ENDED value or None)
+    """
+    pattern = b'\nTRIAL;'
+    trials = 0
+    with open(filepath, 'rb') as f:
+        carry = b''
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            data = carry + chunk
+            trials += data.count(pattern)
+            # shorter than the pattern, so no match is counted twice
+            carry = data[-(len(pattern) - 1):]
+
+        # the session end is written last
+        f.seek(max(f.tell() - tail_size, 0))
+        ended = SESSION_ENDED.findall(f.read())
+    return trials, ended[-1].decode() if ended else None
+
+
+class SessionCatalog:
+    """
+    Catalog of the sessions of a project, stored in <project_path>/sessions.sqlite.
+
+    Query with find() for the common filters or with query() for any SQL condition on
+    COLUMNS, settings holds the full settings json for json_extract.
+    """
+
+    def __init__(self, project_path, filename=CATALOG_FILENAME):
+        self.project_path = project_path
+        self.filepath = os.path.join(project_path, filename)
+        self.connection = sqlite3.connect(self.filepath, timeout=10)
+        self.connection.row_factory = sqlite3.Row
+        self._create()
+
+    def _create(self):
+        # SessionIO.save opens the catalog for every session, only write if the schema changed
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version == CATALOG_VERSION:
+            return
+        with self.connection:
+            if version != CATALOG_VERSION:
+                self.connection.execute('DROP TABLE IF EXISTS sessions')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS sessions ({0}, PRIMARY KEY (path))'.format(
+                ', '.join(COLUMNS)))
+            for column in ('name', 'uuid4', 'setup', 'subject', 'task', 'started'):
+                self.connection.execute('CREATE INDEX IF NOT EXISTS sessions_{0} ON sessions ({0})'.format(column))
+            self.connection.execute('PRAGMA user_version = {0}'.format(CATALOG_VERSION))
+
+    def close(self):
+        self.connection.close()
+
+    ##########################################################################
+    ####### INDEXING #########################################################
+    ##########################################################################
+
+    def session_paths(self):
+        """all session folders of the project that hold a session csv"""
+        paths = []
+        experiments = os.path.join(self.project_path, 'experiments')
+        if not os.path.isdir(experiments):
+            return paths
+        for experiment in sorted(os.listdir(experiments)):
+            setups = os.path.join(experiments, experiment, 'setups')
+            if not os.path.isdir(setups):
+                continue
+            for setup in sorted(os.listdir(setups)):
+                sessions = os.path.join(setups, setup, 'sessions')
+                if not os.path.isdir(sessions):
+                    continue
+                for name in sorted(os.listdir(sessions)):
+                    path = os.path.join(sessions, name)
+                    if os.path.isfile(session_files(path)[0]):
+                        paths.append(path)
+        return paths
+
+    def update(self):
+        """
+        Bring the catalog in line with the sessions tree: index new and changed sessions and
+        drop sessions that no longer exist. Unchanged sessions are only checked with stat.
+
+        :return: number of sessions that were (re)indexed
+        """
+        known = {row['path']: self._stored_stat(row)
+                 for row in self.connection.execute('SELECT path, csv_size, csv_mtime, settings_mtime FROM sessions')}
+        paths = self.session_paths()
+
+        count = 0
+        with self.connection:
+            for path in paths:
+                if known.get(path) != self._stat(path):
+                    self._index(path)
+                    count += 1
+            removed = set(known) - set(paths)
+            self.connection.executemany('DELETE FROM sessions WHERE path = ?', [(path,) for path in removed])
+        return count
+
+    def index_session(self, session_path, previous_path=None):
+        """
+        Index a single session, e.g. after it was saved. previous_path is the folder of the
+        session before it was renamed, its entry is removed. Sessions whose files did not
+        change since they were indexed are skipped.
+
+        :return: True if the session was (re)indexed
+        """
+        with self.connection:
+            if previous_path is not None and previous_path != session_path:
+                self.connection.execute('DELETE FROM sessions WHERE path = ?', (previous_path,))
+            if not os.path.isfile(session_files(session_path)[0]):
+                return False
+            row = self.connection.execute('SELECT csv_size, csv_mtime, settings_mtime FROM sessions WHERE path = ?',
+                                          (session_path,)).fetchone()
+            if row is not None and self._stored_stat(row) == self._stat(session_path):
+                return False
+            self._index(session_path)
+            return True
+
+    def _stored_stat(self, row):
+        return row['csv_size'], row['csv_mtime'], row['settings_mtime']
+
+    def _stat(self, session_path):
+        csv_path, settings_path = session_files(session_path)
+        stat = os.stat(csv_path)
+        settings_mtime = os.stat(settings_path).st_mtime_ns if os.path.exists(settings_path) else None
+        return stat.st_size, stat.st_mtime_ns, settings_mtime
+
+    def _index(self, session_path):
+        csv_path, settings_path = session_files(session_path)
+        csv_size, csv_mtime, settings_mtime = self._stat(session_path)
+        metadata, info = read_header(csv_path)
+        trials, ended = scan_body(csv_path)
+
+        subject, subject_uuid4 = None, None
+        if info.get('SUBJECT-NAME'):
+            try:
+                subject, subject_uuid4 = ast.literal_eval(info['SUBJECT-NAME'][0])
+            except (ValueError, SyntaxError, TypeError):
+                logger.warning('Invalid subject in ' + csv_path)
+
+        settings = {}
+        if settings_mtime is not None:
+            try:
+                with open(settings_path) as f:
+                    settings = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning('Could not read settings ' + settings_path + ': ' + str(e))
+
+        # <project>/experiments/<experiment>/setups/<setup>/sessions/<name>
+        parts = os.path.normpath(session_path).split(os.sep)
+        values = {
+            'path': session_path,
+            'name': parts[-1],
+            'uuid4': metadata.get('__UUID4__'),
+            'experiment': parts[-5] if len(parts) >= 5 else None,
+            'setup': parts[-3] if len(parts) >= 3 else None,
+            'subject': subject,
+            'subject_uuid4': subject_uuid4,
+            'task': (info.get('PROTOCOL-NAME') or [None])[0],
+            'started': (info.get('SESSION-STARTED') or [None])[0],
+            'ended': ended or (info.get('SESSION-ENDED') or [None])[0],
+            'trials': trials,
+            'csv_size': csv_size,
+            'csv_mtime': csv_mtime,
+            'settings_mtime': settings_mtime,
+            'settings': json.dumps(settings) if settings else None,
+        }
+        for column, key in KEY_SETTINGS.items():
+            value = settings.get(key)
+            values['setting_' + column] = json.dumps(value) if isinstance(value, (list, dict)) else value
+
+        self.connection.execute('INSERT OR REPLACE INTO sessions ({0}) VALUES ({1})'.format(
+            ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))), [values[c] for c in COLUMNS])
+
+    ##########################################################################
+    ####### QUERIES ##########################################################
+    ##########################################################################
+
+    def query(self, where='1', params=(), order_by='started'):
+        """
+        Sessions matching an SQL condition, e.g.
+        query("json_extract(settings, '$.gamble_side') = ?", ('Left',))
+
+        :return: list of dicts with COLUMNS as keys
+        """
+        rows = self.connection.execute('SELECT * FROM sessions WHERE {0} ORDER BY {1}'.format(where, order_by), params)
+        return [dict(row) for row in rows]
+
+    def find(self, name=None, uuid4=None, setup=None, subject=None, task=None,
+             started_after=None, started_before=None, min_trials=None):
+        """Sessions matching all given filters, dates compare as 'YYYY-MM-DD HH:MM:SS' strings."""
+        conditions, params = [], []
+        for column, value in (('name', name), ('uuid4', uuid4), ('setup', setup),
+                              ('subject', subject), ('task', task)):
+            if value is not None:
+                conditions.append(column + ' = ?')
+                params.append(value)
+        if started_after is not None:
+            conditions.append('started >= ?')
+            params.append(str(started_after))
+        if started_before is not None:
+            conditions.append('started < ?')
+            params.append(str(started_before))
+        if min_trials is not None:
+            conditions.append('trials >= ?')
+            params.append(min_trials)
+        return self.query(' AND '.join(conditions) or '1', params)
@@ -0,0 +1,181 @@
+# !/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Columnar loader for pybpod session csv files, shared by the session io and the analysis
+scripts.
+
+The body of the csv (everything after the __ metadata rows) is parsed once with typed
+columns: TYPE, MSG and +INFO are categoricals, PC-TIME is a datetime and PC-TIME-MS the
+same time as int64 epoch ms. The parsed columns are written to a .npz sidecar next to the
+csv, keyed by size and mtime of the csv, so loading a session again only reads the arrays.
+
+Usage:
+    from session_csv import load_session_csv
+    df = load_session_csv(filepath)
+    states = df[df.TYPE == 'STATE']
+"""
+
+import csv as std_csv
+import logging
+import os
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+
+from sca.formats import csv
+
+logger = logging.getLogger(__name__)
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+COLUMNS = ['TYPE', 'PC-TIME', 'BPOD-INITIAL-TIME', 'BPOD-FINAL-TIME', 'MSG', '+INFO']
+CATEGORICAL = ['TYPE', 'MSG', '+INFO']
+CACHE_SUFFIX = '.npz'
+CACHE_VERSION = 1
+
+
+def count_metadata_rows(filepath):
+    """number of leading __ metadata rows, the row after them holds the column names"""
+    count = 0
+    with open(filepath) as f:
+        for line in f:
+            if not line.startswith('__'):
+                break
+            count += 1
+    return count
+
+
+def read_header(filepath, max_rows=50):
+    """
+    Read the session header without parsing the body.
+
+    :param filepath: path of the session csv
+    :param max_rows: stop after this many rows that are not INFO
+    :return: (metadata, info), metadata maps the __ keys to their value, info maps every INFO
+        name to the list of its values
+    """
+    nrows = count_metadata_rows(filepath)
+    metadata = {}
+    info = {}
+    with open(filepath, newline='') as f:
+        rows = std_csv.reader(f,
+                              delimiter=csv.CSV_DELIMITER,
+                              quotechar=csv.CSV_QUOTECHAR,
+                              quoting=csv.CSV_QUOTING)
+        for row in islice(rows, nrows):
+            if row:
+                metadata[row[0]] = row[1] if len(row) > 1 else None
+        next(rows, None)  # column names
+
+        count = 0
+        for row in rows:
+            if len(row) < 6 or row[0] != 'INFO':
+                count += 1
+                if count > max_rows:
+                    break
+                continue
+            info.setdefault(row[4], []).append(row[5])
+    return metadata, info
+
+
+def cache_path(filepath):
+    return filepath + CACHE_SUFFIX
+
+
+def load_session_csv(filepath, columns=None, cache=True):
+    """
+    Load the body of a session csv as a DataFrame.
+
+    :param filepath: path of the session csv
+    :param columns: columns to return, by default all of COLUMNS (and PC-TIME-MS)
+    :param cache: read / write the .npz sidecar. without the cache only the requested columns
+        are parsed
+    :return: DataFrame with one row per csv row
+    """
+    if cache:
+        df = _read_cache(filepath)
+        if df is None:
+            df = _parse(filepath, COLUMNS)
+            _write_cache(filepath, df)
+    else:
+        usecols = COLUMNS if columns is None else [c for c in COLUMNS if c in columns or
+                                                   (c == 'PC-TIME' and 'PC-TIME-MS' in columns)]
+        df = _parse(filepath, usecols)
+
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+
+def _parse(filepath, usecols):
+    nrows = count_metadata_rows(filepath)
+    dtype = {c: ('category' if c in CATEGORICAL else str if c == 'PC-TIME' else float) for c in usecols}
+    df = pd.read_csv(filepath,
+                     delimiter=csv.CSV_DELIMITER,
+                     quotechar=csv.CSV_QUOTECHAR,
+                     quoting=csv.CSV_QUOTING,
+                     lineterminator=csv.CSV_LINETERMINATOR,
+                     skiprows=nrows,
+                     usecols=usecols,
+                     dtype=dtype)
+    df = df[[c for c in COLUMNS if c in usecols]]
+    if 'PC-TIME' in df:
+        df['PC-TIME'] = pd.to_datetime(df['PC-TIME'], format=TIME_FORMAT).astype('datetime64[us]')
+        df['PC-TIME-MS'] = _epoch_us(df['PC-TIME']) // 1000
+    return df
+
+
+def _epoch_us(times):
+    return times.to_numpy().astype('datetime64[us]').astype(np.int64)
+
+
+def _stat_key(filepath):
+    stat = os.stat(filepath)
+    return np.array([CACHE_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def _read_cache(filepath):
+    sidecar = cache_path(filepath)
+    if not os.path.exists(sidecar):
+        return None
+    try:
+        with np.load(sidecar) as arrays:
+            if not np.array_equal(arrays['__key__'], _stat_key(filepath)):
+                return None
+            data = {}
+            for column in COLUMNS:
+                if column in CATEGORICAL:
+                    data[column] = pd.Categorical.from_codes(arrays[column + '.codes'],
+                                                             arrays[column + '.categories'])
+                elif column == 'PC-TIME':
+                    data[column] = arrays[column].view('datetime64[us]')
+                else:
+                    data[column] = arrays[column]
+    except (OSError, KeyError, ValueError) as e:
+        logger.warning('Ignoring unreadable cache ' + sidecar + ': ' + str(e))
+        return None
+
+    df = pd.DataFrame(data)
+    df['PC-TIME-MS'] = _epoch_us(df['PC-TIME']) // 1000
+    return df
+
+
+def _write_cache(filepath, df):
+    arrays = {'__key__': _stat_key(filepath)}
+    for column in COLUMNS:
+        if column in CATEGORICAL:
+            arrays[column + '.codes'] = df[column].cat.codes.to_numpy()
+            arrays[column + '.categories'] = np.asarray(df[column].cat.categories, dtype=str)
+        elif column == 'PC-TIME':
+            arrays[column] = _epoch_us(df[column])
+        else:
+            arrays[column] = df[column].to_numpy()
+
+    sidecar = cache_path(filepath)
+    tmp = sidecar + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, sidecar)
+    except OSError as e:
+        logger.warning('Could not write cache ' + sidecar + ': ' + str(e))
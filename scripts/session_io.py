@@ -1,22 +1,41 @@
 # !/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import ast
 import logging
 import os
 import shutil
+import sqlite3
+from collections import namedtuple
+from contextlib import closing
 
-import pandas as pd
-
-from pybpodapi.com.messaging.session_info import SessionInfo
 from pybpodapi.session import Session
-from pybpodgui_api.com.messaging.parser import BpodMessageParser
 from pybpodgui_api.models.session.session_base import SessionBase
-from sca.formats import csv
 
 from pybpodapi.utils import date_parser
 
+from session_catalog import SessionCatalog
+from session_csv import COLUMNS, TIME_FORMAT, cache_path, load_session_csv, read_header
+
 logger = logging.getLogger(__name__)
 
+UUID4_KEY = '__UUID4__'
+
+# INFO rows of the session header and the attribute they are stored in
+INFO_FIELDS = {
+    Session.INFO_SESSION_NAME: 'task_name',
+    Session.INFO_CREATOR_NAME: 'creator',
+    Session.INFO_SESSION_STARTED: 'started',
+    Session.INFO_SESSION_ENDED: 'ended',
+    Session.INFO_SERIAL_PORT: 'board_serial_port',
+    Session.INFO_BOARD_NAME: 'board_name',
+    Session.INFO_SETUP_NAME: 'setup_name',
+    Session.INFO_SUBJECT_NAME: 'subjects',
+}
+
+# header of a session csv, subjects is a tuple of (name, uuid4)
+SessionInfo = namedtuple('SessionInfo', ['uuid4'] + list(INFO_FIELDS.values()))
+
 
 class SessionIO(SessionBase):
     """
@@ -70,6 +89,16 @@ class SessionIO(SessionBase):
                     current_filepath = os.path.join(self.path, self.initial_name+'.csv')
                     future_filepath = os.path.join(self.path, self.name+'.csv')
                     shutil.move(current_filepath, future_filepath)
+                    # the parsed csv sidecar stays valid, the move keeps size and mtime
+                    if os.path.exists(cache_path(current_filepath)):
+                        shutil.move(cache_path(current_filepath), cache_path(future_filepath))
+
+            # keep the project session catalog in line with the renamed / saved session
+            try:
+                with closing(SessionCatalog(self.project.path)) as catalog:
+                    catalog.index_session(self.path, initial_path if self.initial_name is not None else None)
+            except (sqlite3.Error, OSError) as e:
+                logger.warning('Could not update session catalog: ' + str(e))
 
             self.initial_name = self.name
 
@@ -89,8 +118,8 @@ class SessionIO(SessionBase):
 
         try:
             self.filepath = filepath
-            csvreader = self.load_info()
-            self.uuid4 = csvreader.uuid4
+            info = self.load_info()
+            self.uuid4 = info.uuid4
         except FileNotFoundError:
             logger.warning('File not found: '+filepath)
             self.filepath = None
@@ -102,78 +131,74 @@ class SessionIO(SessionBase):
         if not self.filepath:
             return
 
-        nrows = csv.reader.count_metadata_rows(self.filepath)
-        #print(f"\n\n{self.filepath}\n\n")
-        self.data = pd.read_csv(self.filepath,
-                                delimiter=csv.CSV_DELIMITER,
-                                quotechar=csv.CSV_QUOTECHAR,
-                                quoting=csv.CSV_QUOTING,
-                                lineterminator=csv.CSV_LINETERMINATOR,
-                                skiprows=nrows,
-                                memory_map=True
-                                )
-        
-
-        res = self.data.query("MSG=='{0}'".format(Session.INFO_SESSION_ENDED))
-        for index, row in res.iterrows():
-            self.ended = date_parser.parse(row['+INFO'])
-
-        res = self.data.query("TYPE in ['VAL', 'TRIAL'] or MSG=='SESSION-ENDED'")
-        variables = []
-        for index, row in res.iterrows():
-            if row['TYPE'] == 'TRIAL':
-                variables.append(['New trial', None])
-            elif row['MSG'] == 'SESSION-ENDED':
-                variables.append(['Session ended', None])
-            else:
-                variables.append([row['MSG'], row['+INFO']])
-        #self.variables = variables
-
-    def load_info(self):
-        if not self.filepath:
-            return
-
-        with open(self.filepath) as filestream:
-            csvreader = csv.reader(filestream)
-            self.subjects = []
+        # typed columns, read from the cached sidecar if the csv did not change. PC-TIME stays
+        # the csv string and there is no PC-TIME-MS, as plugins expect from session.data
+        self.data = load_session_csv(self.filepath, columns=COLUMNS)
+        self.data['PC-TIME'] = self.data['PC-TIME'].dt.strftime(TIME_FORMAT)
 
-            count = 0
-            for row in csvreader:
-                msg = BpodMessageParser.fromlist(row)
+        if init_func:
+            init_func(len(self.data))
 
-                if msg:
-                    if isinstance(msg, SessionInfo):
-                        if msg.infoname == Session.INFO_SESSION_NAME:
-                            self.task_name = msg.infovalue
+        # the session end from a boolean mask over the typed columns instead of query + iterrows
+        is_ended = (self.data['MSG'] == Session.INFO_SESSION_ENDED).to_numpy()
+        if is_ended.any():
+            self.ended = date_parser.parse(self.data['+INFO'].to_numpy()[is_ended][-1])
 
-                        elif msg.infoname == Session.INFO_CREATOR_NAME:
-                            self.creator = msg.infovalue
+        if update_func:
+            update_func(len(self.data))
+        if end_func:
+            end_func()
 
-                        elif msg.infoname == Session.INFO_SESSION_STARTED:
-                            self.started = date_parser.parse(msg.infovalue)
-
-                        elif msg.infoname == Session.INFO_SESSION_ENDED:
-                            self.ended = date_parser.parse(msg.infovalue)
-
-                        elif msg.infoname == Session.INFO_SERIAL_PORT:
-                            self.board_serial_port = msg.infovalue
-
-                        elif msg.infoname == Session.INFO_BOARD_NAME:
-                            self.board_name = msg.infovalue
-
-                        elif msg.infoname == Session.INFO_SETUP_NAME:
-                            self.setup_name = msg.infovalue
+    def load_info(self):
+        """
+        Reads the session header with session_csv.read_header: the uuid4 from the metadata rows
+        and the INFO rows that follow the column names, so the time does not depend on the
+        length of the session.
 
-                        elif msg.infoname == Session.INFO_SUBJECT_NAME:
-                            self.subjects += [msg.infovalue]
-                            name, uuid4 = eval(msg.infovalue)
-                            subj = self.project.find_subject_by_id(uuid4)
-                            if subj is not None:
-                                subj += self
-                    else:
-                        count += 1
+        :return: SessionInfo
+        """
+        if not self.filepath:
+            return
 
-                if count > 50:
-                    break
+        metadata, info = read_header(self.filepath)
+        values = {}
+        self.subjects = []
+
+        for name, field in INFO_FIELDS.items():
+            for value in info.get(name, ()):
+                if field in ('started', 'ended'):
+                    values[field] = date_parser.parse(value)
+
+                elif field == 'subjects':
+                    self.subjects += [value]
+                    subject = parse_subject(value)
+                    if subject is None:
+                        continue
+                    values.setdefault(field, []).append(subject)
+                    subj = self.project.find_subject_by_id(subject[1])
+                    if subj is not None:
+                        subj += self
+                else:
+                    values[field] = value
+
+        for field, value in values.items():
+            if field != 'subjects':
+                setattr(self, field, value)
+
+        values['subjects'] = tuple(values.get('subjects', ()))
+        return SessionInfo(uuid4=metadata.get(UUID4_KEY),
+                           **{field: values.get(field) for field in INFO_FIELDS.values()})
+
+
+def parse_subject(value):
+    """
+    Parses the SUBJECT-NAME info value, e.g. "['mouse', '471b1622-...']", without evaluating it.
 
-            return csvreader
+    :return: (name, uuid4) or None if the value is not a name / uuid4 pair
+    """
+    try:
+        name, uuid4 = ast.literal_eval(value)
+    except (ValueError, SyntaxError, TypeError):
+        logger.warning('Invalid subject in session header: ' + str(value))
+        return None
+    return str(name), str(uuid4)
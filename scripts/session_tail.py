@@ -0,0 +1,183 @@
+# !/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Incremental reader for the csv of a running pybpod session.
+
+SessionTail remembers the byte offset it has read up to, so every poll only parses the
+complete lines appended since the last one. Rows are returned as typed Record tuples.
+The file is opened for every poll and not kept open, so SessionIO.save can still rename
+the session folder, the tail then finds the file again in its new folder.
+
+Usage:
+    tail = SessionTail(filepath)
+    for record in tail.follow(interval=0.5):     # until SESSION-ENDED or tail.stop()
+        if record.type == 'STATE': ...
+
+    tail = SessionTail(filepath, callback=live_plot.update)
+    tail.poll()                                  # e.g. from a gui timer
+"""
+
+import csv as std_csv
+import logging
+import os
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+from sca.formats import csv
+
+logger = logging.getLogger(__name__)
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+UUID4_KEY = '__UUID4__'
+SESSION_ENDED = 'SESSION-ENDED'
+
+# one row of the session csv. pc_time is a datetime, initial_time / final_time are bpod
+# times in s (None if empty) and trial is the number of TRIAL rows up to this row - 1
+Record = namedtuple('Record', ['type', 'pc_time', 'initial_time', 'final_time', 'msg', 'info', 'trial'])
+
+
+def _float(value):
+    return float(value) if value else None
+
+
+def _uuid4(filepath):
+    with open(filepath, newline='') as f:
+        row = next(std_csv.reader(f, delimiter=csv.CSV_DELIMITER), [])
+    return row[1] if len(row) > 1 and row[0] == UUID4_KEY else None
+
+
+def _time(value):
+    try:
+        return datetime.strptime(value, TIME_FORMAT)
+    except ValueError:
+        return None
+
+
+class SessionTail:
+    """
+    Follows a growing session csv.
+
+    :param filepath: path of the session csv
+    :param callback: called with every new Record
+    """
+
+    def __init__(self, filepath, callback=None):
+        self.filepath = filepath
+        self.callback = callback
+        self._stop = threading.Event()
+        self._reset()
+
+    def _reset(self):
+        self.offset = 0
+        self.metadata = {}
+        self.columns = None
+        self.trial = -1
+        self.ended = False
+        self._identity = None
+
+    def poll(self):
+        """
+        Parse the complete lines appended since the last poll, a partly written last line is
+        left for the next poll.
+
+        :return: list of new Records
+        """
+        try:
+            stat, data = self._read()
+        except FileNotFoundError:
+            # SessionIO.save moved the folder, possibly between stat and open
+            if not self._relocate():
+                return []
+            try:
+                stat, data = self._read()
+            except FileNotFoundError:
+                return []
+
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            return []
+        self.offset += end
+        if self._identity is None:
+            self._identity = (stat.st_dev, stat.st_ino)
+
+        lines = data[:end].decode('utf-8').splitlines()
+        rows = std_csv.reader(lines,
+                              delimiter=csv.CSV_DELIMITER,
+                              quotechar=csv.CSV_QUOTECHAR,
+                              quoting=csv.CSV_QUOTING)
+        records = []
+        for row in rows:
+            record = self._parse(row)
+            if record is None:
+                continue
+            records.append(record)
+            if self.callback:
+                self.callback(record)
+        return records
+
+    def _read(self):
+        # bytes appended since the last poll, only complete up to the size stat returned
+        stat = os.stat(self.filepath)
+        if stat.st_size < self.offset:
+            # a different, shorter file was written under the same name, start over
+            logger.warning('Session file was truncated, reading from the start: ' + self.filepath)
+            self._reset()
+        if stat.st_size == self.offset:
+            return stat, b''
+        with open(self.filepath, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(stat.st_size - self.offset)
+        return stat, data
+
+    def _parse(self, row):
+        if not row:
+            return None
+        if self.columns is None:
+            if row[0].startswith('__'):
+                self.metadata[row[0]] = row[1] if len(row) > 1 else None
+            else:
+                self.columns = row
+            return None
+
+        row = row + [''] * (6 - len(row))
+        if row[0] == 'TRIAL':
+            self.trial += 1
+        elif row[0] == 'INFO' and row[4] == SESSION_ENDED:
+            self.ended = True
+        return Record(row[0], _time(row[1]), _float(row[2]), _float(row[3]), row[4], row[5], self.trial)
+
+    def _relocate(self):
+        """
+        Find the file after SessionIO.save renamed the session folder and csv: a csv in one
+        of the sibling session folders that is the same file, or has the same uuid4.
+        """
+        sessions = os.path.dirname(os.path.dirname(self.filepath))
+        if not os.path.isdir(sessions):
+            return False
+        uuid4 = self.metadata.get(UUID4_KEY)
+        for name in os.listdir(sessions):
+            candidate = os.path.join(sessions, name, name + '.csv')
+            if not os.path.isfile(candidate):
+                continue
+            stat = os.stat(candidate)
+            if (stat.st_dev, stat.st_ino) == self._identity or (uuid4 is not None and _uuid4(candidate) == uuid4):
+                logger.info('Session file moved to ' + candidate)
+                self.filepath = candidate
+                return True
+        return False
+
+    def follow(self, interval=0.5):
+        """
+        Generator of new Records, polls every interval seconds until the session ended or
+        stop() was called.
+        """
+        self._stop.clear()
+        while True:
+            for record in self.poll():
+                yield record
+            if self.ended or self._stop.wait(interval):
+                break
+
+    def stop(self):
+        self._stop.set()